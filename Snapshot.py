@@ -19,61 +19,477 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 
-from typing import Any, Callable, Dict, Generator, Iterator, List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Tuple
 import xxhash
+import errno
+import functools
 import os
 import hashlib
 import json
-from globster import Globster
-from logging import log
+import logging
+import mmap
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from globster import ExceptionGlobster, Globster
+from progress import ProgressTracker
+from sevenzip import SevenZip, is_safe_member, normalize_member
+
+log = logging.getLogger("Snapshot")
 
 IndexerType = Tuple[str, Callable[[str], Any]]
 IndexedDataType = Dict[str, Any]
 IndexType = Dict[str, IndexedDataType]
 DirSnapshotType = Dict[str, IndexType]
+# (directory absolute path, globster) pairs of the ignore files in effect
+IgnoreScopeType = List[Tuple[str, ExceptionGlobster]]
+
+
+def normalize_path(path: str) -> str:
+    """
+    Return the canonical form of a snapshot relative path, with forward
+    slashes on every platform.
+    """
+    if os.sep != '/':
+        path = path.replace(os.sep, '/')
+    return path
+
+
+def sort_index(index: IndexType) -> IndexType:
+    """
+    Return a copy of index with normalized paths, in sorted path order.
+    """
+    return dict(sorted(((normalize_path(path), data)
+                        for path, data in index.items()),
+                       key=lambda item: item[0]))
+
+
+def sort_snapshot(snapshot: DirSnapshotType) -> DirSnapshotType:
+    """
+    Return a copy of snapshot in canonical form: normalized paths, files
+    and subdirs in sorted path order, link groups sorted by inode and
+    their paths sorted. The entry data are shared with snapshot.
+
+    Two snapshots of the same content serialize to the same json.
+    """
+    canonical = dict(snapshot)
+    canonical['files'] = sort_index(snapshot['files'])
+    canonical['subdirs'] = sort_index(snapshot['subdirs'])
+    if 'links' in snapshot:
+        canonical['links'] = dict(
+            (inode, dict(group, paths=sorted(normalize_path(p)
+                                             for p in group['paths'])))
+            for inode, group in sorted(snapshot['links'].items()))
+    return canonical
+
+
+def load_patterns(exclude_file: str) -> List[str]:
+    """
+    Return the list of patterns in a .gitignore like file.
+
+    Blank lines and lines starting with '#' are skipped,
+    trailing whitespace is removed.
+    """
+    patterns = []
+    with open(exclude_file, 'r') as f:
+        for line in f.read().splitlines():
+            line = line.rstrip()
+            if line and not line.startswith('#'):
+                patterns.append(line)
+    return patterns
+
+
+# read_hook of each thread, see set_read_hook
+_read_hooks = threading.local()
+
+
+def set_read_hook(hook: Callable[[int, float], None] = None) -> None:
+    """
+    Set the callable the FileIndexers.read_blocks of the calling thread
+    call with the size of each block read and the seconds spent reading
+    it, eg. to throttle them. None removes it.
+    """
+    _read_hooks.hook = hook
+
+
+class PhaseObserver(object):
+    """
+    Receives the measures of the snapshot phases, once registered with
+    add_observer.
+
+    Phases are "walk" (listing and filtering one directory, exclusion
+    included), "exclude" (one Dir.is_excluded call), "stat",
+    "file:<indexer>" and "subdir:<indexer>" (one indexer on one entry),
+    "json_dump" and "json_load". cpu is the time of the calling thread,
+    nbytes the size of the file for "file:" phases and of the json data.
+    """
+
+    def on_phase(self, phase: str, wall: float, cpu: float,
+                 count: int = 1, nbytes: int = 0) -> None:
+        pass
+
+
+# registered PhaseObserver, the phases are only measured when not empty
+_observers: List[PhaseObserver] = []
+
+
+def add_observer(observer: PhaseObserver) -> None:
+    _observers.append(observer)
+
+
+def remove_observer(observer: PhaseObserver) -> None:
+    _observers.remove(observer)
+
+
+def _clock() -> Tuple[float, float]:
+    return time.perf_counter(), time.thread_time()
+
+
+def _notify(phase: str, clock: Tuple[float, float],
+            count: int = 1, nbytes: int = 0) -> None:
+    """
+    Report to the observers the time elapsed since clock (see _clock).
+    """
+    wall = time.perf_counter() - clock[0]
+    cpu = time.thread_time() - clock[1]
+    for observer in list(_observers):
+        observer.on_phase(phase, wall, cpu, count, nbytes)
+
+
+class PhaseProfiler(PhaseObserver):
+    """
+    Observer totaling the count, bytes, wall and cpu time of each phase.
+
+    Use as a context manager to observe a block:
+
+        with PhaseProfiler() as profiler:
+            snapshot_dir(path)
+        print(profiler.report())
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases: Dict[str, Dict[str, float]] = {}
+
+    def on_phase(self, phase: str, wall: float, cpu: float,
+                 count: int = 1, nbytes: int = 0) -> None:
+        with self._lock:
+            totals = self.phases.get(phase)
+            if totals is None:
+                totals = self.phases[phase] = {
+                    'calls': 0, 'count': 0, 'bytes': 0,
+                    'wall': 0.0, 'cpu': 0.0}
+            totals['calls'] += 1
+            totals['count'] += count
+            totals['bytes'] += nbytes
+            totals['wall'] += wall
+            totals['cpu'] += cpu
+
+    def __enter__(self) -> 'PhaseProfiler':
+        add_observer(self)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        remove_observer(self)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Return a copy of the totals of each phase.
+        """
+        with self._lock:
+            return dict((phase, dict(totals))
+                        for phase, totals in self.phases.items())
+
+    def report(self) -> str:
+        """
+        Return a table of the phases, slowest first.
+        """
+        lines = ["{0:<24} {1:>9} {2:>12} {3:>10} {4:>10} {5:>9}".format(
+            "phase", "count", "bytes", "wall s", "cpu s", "MB/s")]
+        summary = self.summary()
+        for phase in sorted(summary, key=lambda p: -summary[p]['wall']):
+            totals = summary[phase]
+            rate = ("{0:9.1f}".format(totals['bytes'] / totals['wall'] / 1e6)
+                    if totals['bytes'] and totals['wall'] else "")
+            lines.append(
+                "{0:<24} {1:>9} {2:>12} {3:>10.4f} {4:>10.4f} {5:>9}".format(
+                    phase, totals['count'], totals['bytes'],
+                    totals['wall'], totals['cpu'], rate))
+        return "\n".join(lines)
 
 
 class FileIndexers:
     """
     """
 
+    # Holes are fed to the digests from this buffer instead of being read.
+    _ZEROS = bytes(1048576)
+
+    # Page cache modes of read_blocks.
+    CACHE_MODES = ("normal", "dontneed", "direct")
+    # Bytes read between two POSIX_FADV_DONTNEED in "dontneed" mode.
+    _DONTNEED_CHUNK = 8388608
+    # Alignment of the O_DIRECT buffer sizes.
+    _DIRECT_ALIGN = 4096
+
     @staticmethod
-    def sha256_file(filepath: str, blocksize: int = 4096) -> str:
+    def sha256_file(filepath: str, blocksize: int = 4096,
+                    sparse: bool = False, cache: str = "normal") -> str:
         """
         """
         sha = hashlib.sha256()
-        with open(filepath, 'rb') as fp:
-            while 1:
-                data = fp.read(blocksize)
-                if data:
-                    sha.update(data)
-                else:
-                    break
+        for data in FileIndexers.read_blocks(filepath, blocksize, sparse,
+                                             cache):
+            sha.update(data)
         return sha.hexdigest()
 
     @staticmethod
-    def xxhash_file(filepath: str, blocksize: int = 4096) -> str:
+    def xxhash_file(filepath: str, blocksize: int = 4096,
+                    sparse: bool = False, cache: str = "normal") -> str:
         xxhash64 = xxhash.xxh64()
+        for data in FileIndexers.read_blocks(filepath, blocksize, sparse,
+                                             cache):
+            xxhash64.update(data)
+        return xxhash64.hexdigest()
+
+    @classmethod
+    def read_blocks(cls, filepath: str, blocksize: int = 4096,
+                    sparse: bool = False,
+                    cache: str = "normal") -> Iterator[bytes]:
+        """
+        Yield the content of a file by chunks of blocksize.
+
+        With sparse, holes are located with SEEK_DATA / SEEK_HOLE and
+        yielded as zeros without reading them. The content yielded is the
+        same, so are the digests. Falls back to reading everything where
+        SEEK_DATA is not supported.
+
+        cache limits the page cache used by the read:
+            - "normal": regular buffered reads.
+            - "dontneed": reads advised POSIX_FADV_SEQUENTIAL, and the
+              pages read dropped with POSIX_FADV_DONTNEED as the read
+              goes, also those that were cached before the read.
+            - "direct": O_DIRECT reads bypassing the page cache, in
+              blocksize rounded up to _DIRECT_ALIGN. Falls back to
+              "dontneed" where O_DIRECT is refused, and for sparse reads.
+              The blocks are views of a reused buffer, only valid until
+              the next one is yielded.
+        Without posix_fadvise or O_DIRECT, eg. on Windows, both modes
+        read like "normal".
+
+        The read hook of the thread, see set_read_hook, is called with
+        the size of each block read and the time spent reading it alone,
+        not processing the previous block.
+        """
+        if cache not in cls.CACHE_MODES:
+            raise ValueError("Unknown cache mode: {0}".format(cache))
+        hook = getattr(_read_hooks, 'hook', None)
+        if hook is None:
+            yield from cls._read_blocks(filepath, blocksize, sparse, cache)
+            return
+        blocks = cls._read_blocks(filepath, blocksize, sparse, cache)
+        while 1:
+            start = time.monotonic()
+            data = next(blocks, None)
+            elapsed = time.monotonic() - start
+            if data is None:
+                break
+            hook(len(data), elapsed)
+            yield data
+
+    @classmethod
+    def _read_blocks(cls, filepath: str, blocksize: int, sparse: bool,
+                     cache: str) -> Iterator[bytes]:
+        if cache == "direct" and not sparse and hasattr(os, 'O_DIRECT'):
+            yield from cls._read_direct_blocks(filepath, blocksize)
+            return
         with open(filepath, 'rb') as fp:
+            if cache != "normal" and hasattr(os, 'posix_fadvise'):
+                blocks = cls._drop_read_pages(fp, cls._read_file_blocks(
+                    fp, blocksize, sparse))
+            else:
+                blocks = cls._read_file_blocks(fp, blocksize, sparse)
+            yield from blocks
+
+    @classmethod
+    def _read_file_blocks(cls, fp, blocksize: int,
+                          sparse: bool) -> Iterator[bytes]:
+        if sparse and hasattr(os, 'SEEK_DATA'):
+            try:
+                os.lseek(fp.fileno(), 0, os.SEEK_DATA)
+                sparse_supported = True
+            except OSError as exc:
+                # ENXIO: no data at all, the whole file is a hole
+                sparse_supported = exc.errno == errno.ENXIO
+            if sparse_supported:
+                yield from cls._read_sparse_blocks(fp, blocksize)
+                return
+            fp.seek(0)
+        while 1:
+            data = fp.read(blocksize)
+            if data:
+                yield data
+            else:
+                break
+
+    @classmethod
+    def _drop_read_pages(cls, fp, blocks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Pass blocks through, dropping the pages of fp read so far from
+        the page cache every _DONTNEED_CHUNK bytes and at the end.
+        """
+        fd = fp.fileno()
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        dropped = 0
+        try:
+            for data in blocks:
+                yield data
+                offset = fp.tell()
+                if offset - dropped >= cls._DONTNEED_CHUNK:
+                    os.posix_fadvise(fd, dropped, offset - dropped,
+                                     os.POSIX_FADV_DONTNEED)
+                    dropped = offset
+        finally:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    @classmethod
+    def _read_direct_blocks(cls, filepath: str,
+                            blocksize: int) -> Iterator[bytes]:
+        try:
+            fd = os.open(filepath, os.O_RDONLY | os.O_DIRECT)
+        except OSError as exc:
+            # EINVAL: the file system does not support O_DIRECT, eg. tmpfs
+            if exc.errno != errno.EINVAL:
+                raise
+            yield from cls._read_blocks(filepath, blocksize, False,
+                                        "dontneed")
+            return
+        size = -(-blocksize // cls._DIRECT_ALIGN) * cls._DIRECT_ALIGN
+        # anonymous mmaps are page aligned, as O_DIRECT needs
+        buf = mmap.mmap(-1, size)
+        view = memoryview(buf)
+        try:
+            offset = 0
             while 1:
-                data = fp.read(blocksize)
-                if data:
-                    xxhash64.update(data)
-                else:
+                try:
+                    count = os.readv(fd, [buf])
+                except OSError as exc:
+                    if exc.errno != errno.EINVAL or offset:
+                        raise
+                    # O_DIRECT accepted on open but not on read
+                    yield from cls._read_blocks(filepath, blocksize, False,
+                                                "dontneed")
+                    return
+                if not count:
                     break
-        return xxhash64.hexdigest()
+                yield view[:count]
+                offset += count
+                if count < size:
+                    # end of file, the offset is now unaligned
+                    break
+        finally:
+            os.close(fd)
+            view.release()
+            try:
+                buf.close()
+            except BufferError:
+                # the caller still holds the last block, the buffer is
+                # freed with it
+                pass
+
+    @classmethod
+    def _read_sparse_blocks(cls, fp, blocksize: int) -> Iterator[bytes]:
+        fd = fp.fileno()
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as exc:
+                if exc.errno != errno.ENXIO:
+                    raise
+                data_start = size
+            data_start = min(data_start, size)
+            while offset < data_start:
+                length = min(len(cls._ZEROS), data_start - offset)
+                yield memoryview(cls._ZEROS)[:length]
+                offset += length
+            if offset >= size:
+                break
+            data_end = min(os.lseek(fd, offset, os.SEEK_HOLE), size)
+            fp.seek(offset)
+            while offset < data_end:
+                data = fp.read(min(blocksize, data_end - offset))
+                if not data:
+                    # truncated while reading
+                    return
+                yield data
+                offset += len(data)
+
+    # Indexers that can also be computed on a stream, eg. an archive member,
+    # by name / hashlib like factory.
+    STREAM_HASHERS: Dict[str, Callable] = {
+        "xxhash": xxhash.xxh64,
+        "sha256": hashlib.sha256,
+    }
 
     @classmethod
-    def XXHASH64(cls) -> IndexerType:
-        return ("xxhash", cls.xxhash_file)
+    def hash_stream(cls, stream, names: List[str],
+                    blocksize: int = 1048576) -> IndexedDataType:
+        """
+        Compute the STREAM_HASHERS listed in names reading stream once.
+
+        Returns:
+            dict of indexer name / hexdigest, names without a stream
+            hasher are left out.
+        """
+        hashers = dict((name, cls.STREAM_HASHERS[name]()) for name in names
+                       if name in cls.STREAM_HASHERS)
+        while 1:
+            data = stream.read(blocksize)
+            if data:
+                for hasher in hashers.values():
+                    hasher.update(data)
+            else:
+                break
+        return dict((name, hasher.hexdigest())
+                    for name, hasher in hashers.items())
+
+    @staticmethod
+    def _hasher(name: str, func: Callable[[str], str], sparse: bool,
+                cache: str) -> IndexerType:
+        if cache not in FileIndexers.CACHE_MODES:
+            raise ValueError("Unknown cache mode: {0}".format(cache))
+        options = {}
+        if sparse:
+            options['sparse'] = True
+        if cache != "normal":
+            options['cache'] = cache
+        if options:
+            return (name, functools.partial(func, **options))
+        return (name, func)
+
+    @classmethod
+    def XXHASH64(cls, sparse: bool = False,
+                 cache: str = "normal") -> IndexerType:
+        """
+        sparse skips reading holes, the digests are the same either way.
+        cache is the page cache mode of the reads, see read_blocks.
+        """
+        return cls._hasher("xxhash", cls.xxhash_file, sparse, cache)
 
     @classmethod
     def GETMTIME(cls) -> IndexerType:
         return ("getmtime", os.path.getmtime)
 
     @classmethod
-    def SHA256(cls) -> IndexerType:
-        return ("sha256", cls.sha256_file)
+    def SHA256(cls, sparse: bool = False,
+               cache: str = "normal") -> IndexerType:
+        """
+        sparse skips reading holes, the digests are the same either way.
+        cache is the page cache mode of the reads, see read_blocks.
+        """
+        return cls._hasher("sha256", cls.sha256_file, sparse, cache)
 
 
 class Dir(object):
@@ -94,17 +510,23 @@ class Dir(object):
             None by default, you can also load .gitignore files.
         excludes (list): List of additional patterns for exclusion,
             by default: ['.git/', '.hg/', '.svn/']
+        ignore_files (list): Names of per directory ignore files,
+            eg. ['.gitignore', '.exclude'], looked up in every walked
+            directory and applied to its contents with gitignore
+            semantics. None by default.
     """
 
     def __init__(self, directory=".", exclude_file: str = None,
-                 excludes=['.git/', '.hg/', '.svn/']):
+                 excludes=['.git/', '.hg/', '.svn/'],
+                 ignore_files: List[str] = None):
 
         if not os.path.isdir(directory):
             raise TypeError("Directory must be a directory.")
         self.directory = os.path.basename(directory)
         self.path = os.path.abspath(directory)
         self.parent = os.path.dirname(self.path)
-        self.patterns = excludes
+        self.patterns = list(excludes)
+        self.ignore_files = ignore_files or []
         self._files_cache: List[str] = []
         self._sub_dirs_cache: List[str] = []
         self._is_populated = False
@@ -112,10 +534,7 @@ class Dir(object):
         if exclude_file:
             self.exclude_file = os.path.join(self.path, exclude_file)
             if os.path.isfile(self.exclude_file):
-                file_patt = filter(None,
-                                   open(exclude_file)
-                                   .read().split("\n"))
-                self.patterns.extend(file_patt)
+                self.patterns.extend(load_patterns(self.exclude_file))
 
         self.globster = Globster(self.patterns)
 
@@ -123,37 +542,212 @@ class Dir(object):
         """ 
         Return whether 'path' is ignored based on exclude patterns
         """
+        observed = _observers and _clock()
         match = self.globster.match(self.relpath(path))
+        if observed:
+            _notify("exclude", observed)
         if match:
             log.debug("{0} matched {1} for exclusion".format(path, match))
             return True
         return False
 
-    def walk(self) -> Generator[Tuple[str, list[str], list[str]]]:
+    def is_ignored(self, path: str) -> bool:
+        """
+        Return whether the absolute path is left out like Dir.walk would:
+        excluded by the patterns, alone or through a parent directory,
+        or by the ignore files of its directories, read again each call.
+        """
+        rel = os.path.relpath(path, self.path)
+        if rel == os.curdir:
+            return False
+        parts = rel.split(os.sep)
+        root = self.path
+        ignores: IgnoreScopeType = []
+        inherited = False
+        for depth, name in enumerate(parts, 1):
+            child = os.path.join(root, name)
+            if self.is_excluded(child):
+                return True
+            if not self.ignore_files:
+                continue
+            ignores = self._load_ignore_scope(root, ignores)
+            inherited = self._is_scope_excluded(child, ignores, inherited)
+            if (inherited and depth < len(parts)
+                    and not self._may_reinclude_under(child, ignores)):
+                return True
+            root = child
+        return inherited
+
+    def walk(self) -> Iterator[Tuple[str, List[str], List[str]]]:
         """
         Walk the directory like os.path
         (yields a 3-tuple (dirpath, dirnames, filenames)
         except it exclude all files/directories on the fly. 
+
+        Ignore files named in Dir.ignore_files are loaded from each
+        directory as it is reached and apply to everything below it,
+        deeper files taking precedence. A directory excluded by them is
+        pruned unless an exception ('!') pattern could re-include
+        something below it, in which case it is walked without being
+        listed and only re-included entries are reported.
         """
+        # root -> (ignore scope, excluded by an ancestor), filled in
+        # for each directory before os.walk reaches it.
+        scopes = {self.path: ([], False)}
+        observed = _observers and _clock()
         for root, dirs, files in os.walk(self.path, topdown=True):
-            # TODO relative walk, recursive call if root excluder found???
-            #root_excluder = get_root_excluder(root)
-            ndirs = []
-            # First we exclude directories
-            for d in list(dirs):
-                if self.is_excluded(os.path.join(root, d)):
-                    dirs.remove(d)
-                elif not os.path.islink(os.path.join(root, d)):
-                    ndirs.append(d)
-
-            nfiles = []
-            for fpath in (os.path.join(root, f) for f in files):
-                if not self.is_excluded(fpath) and not os.path.islink(fpath):
-                    nfiles.append(os.path.relpath(fpath, root))
-
+            ignores, inherited = scopes.pop(root, ([], False))
+            ndirs, nfiles, descend = self._filter_dir(root, dirs, files,
+                                                      ignores, inherited)
+            dirs[:] = [d for d, _, _ in descend]
+            for d, scope, excluded in descend:
+                scopes[os.path.join(root, d)] = (scope, excluded)
+
+            if observed:
+                _notify("walk", observed, len(ndirs) + len(nfiles))
             yield root, ndirs, nfiles
+            observed = observed and _clock()
 
-    def populate(self, force_refresh=False) -> None:
+    def _filter_dir(self, root: str, dirs: List[str], files: List[str],
+                    ignores: IgnoreScopeType, inherited: bool):
+        """
+        Apply the exclusions to the dirs and files listed in root.
+
+        Returns:
+            the dirs and files to report, and (name, ignore scope,
+            excluded by an ancestor) of the dirs to walk, in order.
+        """
+        if self.ignore_files:
+            ignores = self._load_ignore_scope(root, ignores)
+        ndirs = []
+        descend = []
+        # First we exclude directories
+        for d in dirs:
+            dpath = os.path.join(root, d)
+            if self.is_excluded(dpath) or os.path.islink(dpath):
+                continue
+            elif self._is_scope_excluded(dpath, ignores, inherited):
+                if self._may_reinclude_under(dpath, ignores):
+                    descend.append((d, ignores, True))
+            else:
+                descend.append((d, ignores, False))
+                ndirs.append(d)
+
+        nfiles = []
+        for fpath in (os.path.join(root, f) for f in files):
+            if (not self.is_excluded(fpath)
+                    and not os.path.islink(fpath)
+                    and not self._is_scope_excluded(fpath, ignores,
+                                                    inherited)):
+                nfiles.append(os.path.relpath(fpath, root))
+        return ndirs, nfiles, descend
+
+    def walk_parallel(self, workers: int = 8
+                      ) -> Iterator[Tuple[str, List[str], List[str]]]:
+        """
+        Walk like Dir.walk, listing directories with workers threads.
+
+        Each directory listed queues its subdirectories to the pool, so
+        the threads share the whole tree instead of one subtree each and
+        the latency of listing and stat'ing, eg. on a network or cold
+        file system, is overlapped. The directories are yielded in the
+        same top-down order as Dir.walk, each as soon as it and the ones
+        before it are listed.
+        """
+        executor = ThreadPoolExecutor(max_workers=max(1, workers),
+                                      thread_name_prefix="dir-walker")
+        try:
+            stack = [executor.submit(self._walk_task, executor, self.path,
+                                     [], False)]
+            while stack:
+                result = stack.pop().result()
+                if result is None:
+                    continue
+                root, ndirs, nfiles, children = result
+                yield root, ndirs, nfiles
+                stack.extend(reversed(children))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _walk_task(self, executor: ThreadPoolExecutor, root: str,
+                   ignores: IgnoreScopeType, inherited: bool):
+        """
+        List and filter root for walk_parallel and queue its subdirs.
+
+        Returns:
+            root, its dirs and files, and the futures of the subdirs, or
+            None when root can not be listed (skipped like os.walk does).
+        """
+        observed = _observers and _clock()
+        dirs = []
+        files = []
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    (dirs if is_dir else files).append(entry.name)
+        except OSError:
+            return None
+        ndirs, nfiles, descend = self._filter_dir(root, dirs, files,
+                                                  ignores, inherited)
+        children: List[Future] = []
+        for d, scope, excluded in descend:
+            try:
+                children.append(executor.submit(
+                    self._walk_task, executor, os.path.join(root, d),
+                    scope, excluded))
+            except RuntimeError:
+                # the walk was closed, executor shut down
+                break
+        if observed:
+            _notify("walk", observed, len(ndirs) + len(nfiles))
+        return root, ndirs, nfiles, children
+
+    def _load_ignore_scope(self, root: str,
+                           ignores: IgnoreScopeType) -> IgnoreScopeType:
+        """
+        Return the ignore scope for root: the parent one plus the patterns
+        of the ignore files found in root, if any.
+        """
+        patterns = []
+        for name in self.ignore_files:
+            ignore_file = os.path.join(root, name)
+            if os.path.isfile(ignore_file):
+                patterns.extend(load_patterns(ignore_file))
+        if not patterns:
+            return ignores
+        return ignores + [(root, ExceptionGlobster(patterns))]
+
+    @staticmethod
+    def _is_scope_excluded(path: str, ignores: IgnoreScopeType,
+                           inherited: bool) -> bool:
+        """
+        Return whether path is excluded by the innermost ignore file with
+        an opinion about it, or by an excluded ancestor.
+        """
+        for base, globster in reversed(ignores):
+            state = globster.excluded(
+                os.path.relpath(path, base).replace(os.sep, '/'))
+            if state is not None:
+                return state
+        return inherited
+
+    @staticmethod
+    def _may_reinclude_under(path: str, ignores: IgnoreScopeType) -> bool:
+        """
+        Return whether any exception pattern in scope could match
+        something below the directory path.
+        """
+        for base, globster in ignores:
+            if (globster.has_exceptions() and globster.may_reinclude_under(
+                    os.path.relpath(path, base).replace(os.sep, '/'))):
+                return True
+        return False
+
+    def populate(self, force_refresh=False, workers: int = 1) -> None:
         """
         Walk the directory recursively and populate a cache of it's contents.
 
@@ -163,6 +757,8 @@ class Dir(object):
         Args:
             force_refresh (bool): Whether to refresh from disk if cache
                                   is already populated.
+            workers (int): number of threads listing directories, above
+                1 walk_parallel is used, the caches are the same.
         """
         if not force_refresh and self._is_populated:
             return
@@ -170,7 +766,8 @@ class Dir(object):
         self._files_cache.clear()
         self._sub_dirs_cache.clear()
 
-        for root, dirs, files in self.walk():
+        walk = self.walk_parallel(workers) if workers > 1 else self.walk()
+        for root, dirs, files in walk:
             for f in files:
                 relpath = self.relpath(os.path.join(root, f))
                 self._files_cache.append(relpath)
@@ -189,7 +786,7 @@ class Dir(object):
         self._is_populated = False
 
     def iterfiles(self, include_pattern: str = None,
-                  abspath=False, force_refresh=False) -> Generator[str]:
+                  abspath=False, force_refresh=False) -> Iterator[str]:
         """ 
         Generator for all the files matching pattern and not already excluded.
 
@@ -202,7 +799,8 @@ class Dir(object):
         """
         self.populate(force_refresh)
 
-        globster = Globster([include_pattern])
+        if include_pattern is not None:
+            globster = Globster([include_pattern])
 
         for f in self._files_cache:
             if include_pattern is None or globster.match(f):
@@ -213,7 +811,7 @@ class Dir(object):
 
     def itersubdirs(self, pattern:str=None, 
                     abspath=False, 
-                    force_refresh=False) -> Generator[str]:
+                    force_refresh=False) -> Iterator[str]:
         """
         Generator for all subdirs matching pattern and not excluded.
 
@@ -226,7 +824,8 @@ class Dir(object):
         """
         self.populate(force_refresh)
 
-        globster = Globster([pattern])
+        if pattern is not None:
+            globster = Globster([pattern])
 
         for d in self._sub_dirs_cache:
             if pattern is None or globster.match(d):
@@ -284,9 +883,10 @@ class Dir(object):
 
     def relpath(self, path: str) -> str:
         """ 
-        Return a relative filepath to path from Dir path.
+        Return a relative filepath to path from Dir path,
+        normalized with normalize_path.
         """
-        return os.path.relpath(path, start=self.path)
+        return normalize_path(os.path.relpath(path, start=self.path))
 
     def abspath(self, relpath: str) -> str:
         """
@@ -330,38 +930,265 @@ class Dir(object):
     """
 
 
-def index_files(dir: Dir, file_idx_methods={}) -> dict:
+class ArchiveDir(object):
+    """
+    Read only Dir counterpart backed by the members of an archive.
+
+    Lists files and subdirs like Dir does, with relative paths using
+    '/', so that snapshot_archive can produce snapshots comparable
+    with the ones of snapshot_dir without extracting anything.
+
+    Args:
+        archive_path (str): Path of the archive to wrap.
+        root (str): Path inside the archive to use as root, eg. the
+            single top level folder of the archive. '' by default.
+        excludes (list): List of additional patterns for exclusion,
+            by default: ['.git/', '.hg/', '.svn/']
+    """
+
+    def __init__(self, archive_path: str, root: str = "",
+                 excludes=['.git/', '.hg/', '.svn/']):
+        if not os.path.isfile(archive_path):
+            raise TypeError("Archive must be a file.")
+        self.archive_path = os.path.abspath(archive_path)
+        self.directory = os.path.basename(archive_path)
+        self.path = self.archive_path
+        self.root = root.replace('\\', '/').strip('/')
+        self.patterns = list(excludes)
+        self.globster = Globster(self.patterns)
+        self._files_cache: List[str] = []
+        self._sub_dirs_cache: List[str] = []
+        self._is_populated = False
+
+    def member_relpath(self, member_path: str) -> str:
+        """
+        Return the relative path of an archive member, see
+        normalize_member, or None if it is the archive root, outside of
+        root, excluded or unsafe to extract (absolute or with '..'
+        components).
+        """
+        member_path = normalize_member(member_path)
+        if not member_path:
+            return None
+        if not is_safe_member(member_path):
+            log.warning("Skipping unsafe archive member {0}".format(
+                member_path))
+            return None
+        if self.root:
+            if not member_path.startswith(self.root + '/'):
+                return None
+            member_path = member_path[len(self.root) + 1:]
+        if not member_path or self.globster.match(member_path):
+            return None
+        # a member is excluded also if one of its parent folders is
+        parent = os.path.dirname(member_path)
+        while parent:
+            if self.globster.match(parent):
+                return None
+            parent = os.path.dirname(parent)
+        return member_path
+
+    def populate(self, force_refresh=False) -> None:
+        """
+        List the archive and populate a cache of it's contents.
+
+        Folders missing an entry of their own are added from
+        the paths of their contents.
+        """
+        if not force_refresh and self._is_populated:
+            return
+
+        self._files_cache.clear()
+        self._sub_dirs_cache.clear()
+
+        sub_dirs = set()
+        for entry in SevenZip.list_archive_entries(self.archive_path):
+            relpath = self.member_relpath(entry.path)
+            if relpath is None:
+                continue
+            if entry.is_dir:
+                sub_dirs.add(relpath)
+            else:
+                self._files_cache.append(relpath)
+            parent = os.path.dirname(relpath)
+            while parent and parent not in sub_dirs:
+                sub_dirs.add(parent)
+                parent = os.path.dirname(parent)
+        self._sub_dirs_cache.extend(sorted(sub_dirs))
+
+        self._is_populated = True
+
+    def depopulate(self) -> None:
+        """
+        Clear the cached lists of files and folders, set depopulated state.
+        """
+        self._files_cache.clear()
+        self._sub_dirs_cache.clear()
+        self._is_populated = False
+
+    def iterfiles(self, include_pattern: str = None,
+                  abspath=False, force_refresh=False) -> Iterator[str]:
+        """
+        Generator for all the files matching pattern and not excluded.
+
+        Absolute paths are virtual, the archive path joined with the
+        relative path, and can't be opened.
+        """
+        self.populate(force_refresh)
+
+        if include_pattern is not None:
+            globster = Globster([include_pattern])
+
+        for f in self._files_cache:
+            if include_pattern is None or globster.match(f):
+                if abspath:
+                    yield os.path.join(self.path, f)
+                else:
+                    yield f
+
+    def itersubdirs(self, pattern: str = None,
+                    abspath=False,
+                    force_refresh=False) -> Iterator[str]:
+        """
+        Generator for all subdirs matching pattern and not excluded.
+        """
+        self.populate(force_refresh)
+
+        if pattern is not None:
+            globster = Globster([pattern])
+
+        for d in self._sub_dirs_cache:
+            if pattern is None or globster.match(d):
+                if abspath:
+                    yield os.path.join(self.path, d)
+                else:
+                    yield d
+
+    def files(self, pattern: str = None,
+              sort_key=lambda k: k,
+              sort_reverse=False,
+              abspath=False,
+              force_refresh=False) -> List[str]:
+        """
+        Return a sorted list containing relative path of all files.
+        """
+        return sorted(self.iterfiles(pattern, abspath, force_refresh),
+                      key=sort_key,
+                      reverse=sort_reverse)
+
+    def subdirs(self, pattern: str = None,
+                sort_key=lambda k: k,
+                sort_reverse=False, abspath=False,
+                force_refresh=False) -> List[str]:
+        """
+        Return a sorted list containing relative path of all subdirs.
+        """
+        return sorted(self.itersubdirs(pattern, abspath, force_refresh),
+                      key=sort_key,
+                      reverse=sort_reverse)
+
+    def size(self) -> int:
+        """
+        Return total uncompressed size in bytes of the listed files.
+        """
+        files = set(self.iterfiles())
+        dir_size = 0
+        for entry in SevenZip.list_archive_entries(self.archive_path):
+            if not entry.is_dir and self.member_relpath(entry.path) in files:
+                dir_size += entry.size
+        return dir_size
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
+
+
+def index_files(dir: Dir, file_idx_methods={},
+                link_groups: Dict[str, List[str]] = None,
+                progress: ProgressTracker = None) -> dict:
     """
     Generate the files indexes using the idx_methods.
+
+    If link_groups is passed, hardlinked files are computed once per
+    inode, the other links get a copy of the data, and link_groups is
+    filled with "st_dev:st_ino" / relative paths of the inodes linked
+    more than once in the dir.
+
+    If progress is passed, each indexed file and each error is reported
+    to it.
+
+    The files are indexed in walk order and returned in sorted path
+    order, see sort_index.
     
     Returns:
         files_index (dict): dictionary of relative file paths and 
             associated data: 
                 Eg. relpath : {methodName : data, methodName : data}
     """
+    # name / function tuples as passed to snapshot_dir
+    file_idx_methods = dict(file_idx_methods)
     files_index = {}
+    if link_groups is None:
+        for f in dir.iterfiles():
+            files_index[f] = compute_file(dir, f, file_idx_methods, progress)
+            if progress is not None:
+                progress.indexed(f, _file_size(dir.abspath(f)))
+        return sort_index(files_index)
+
+    inodes = {}
     for f in dir.iterfiles():
-        files_index[f] = compute_file(dir, f, file_idx_methods)
-    return files_index
-
-
-def index_subdirs(dir: Dir, dir_idx_methods={}) -> dict:
+        observed = _observers and _clock()
+        try:
+            st = os.lstat(dir.abspath(f))
+        except OSError as exc:
+            _report_error(progress, f, "stat", exc)
+            st = None
+        if observed:
+            _notify("stat", observed)
+        if st is None or st.st_nlink < 2:
+            files_index[f] = compute_file(dir, f, file_idx_methods, progress)
+        else:
+            inode = "{0}:{1}".format(st.st_dev, st.st_ino)
+            if inode in inodes:
+                files_index[f] = dict(files_index[inodes[inode][0]])
+                inodes[inode].append(f)
+            else:
+                files_index[f] = compute_file(dir, f, file_idx_methods,
+                                              progress)
+                inodes[inode] = [f]
+        if progress is not None:
+            progress.indexed(f, 0 if st is None else st.st_size)
+    # the other links of an inode may be outside of the dir
+    link_groups.update((inode, paths) for inode, paths in inodes.items()
+                       if len(paths) > 1)
+    return sort_index(files_index)
+
+
+def index_subdirs(dir: Dir, dir_idx_methods={},
+                  progress: ProgressTracker = None) -> dict:
     """
     Generate the directory indexes using the idx_methods.
+    Errors are reported to progress if passed.
+    The index is in sorted path order, see sort_index.
     Returns:
         dirs_index (dict): dictionary of relative dir paths and 
             associated data: 
                 Eg. relpath : {methodName : data, methodName : data}
     """
+    dir_idx_methods = dict(dir_idx_methods)
     dirs_index = {}
     for d in dir.itersubdirs():
-        dirs_index[d] = compute_subdir(dir, d, dir_idx_methods)
-    return dirs_index
+        dirs_index[d] = compute_subdir(dir, d, dir_idx_methods, progress)
+    return sort_index(dirs_index)
 
 
 def update_file_index(dir: Dir, file_index={},
                       file_idx_methods={},
-                      files_to_update=None) -> dict:
+                      files_to_update=None,
+                      journal=None) -> dict:
     """
     Add additional data to files_index using file_idx_methods.
 
@@ -372,7 +1199,7 @@ def update_file_index(dir: Dir, file_index={},
 
     Existing files in the index are not removed if missing.
 
-    If data can't be computed a message is printed but the file
+    If data can't be computed a warning is logged but the file
     entry is added anyways.
 
     Args:
@@ -382,30 +1209,38 @@ def update_file_index(dir: Dir, file_index={},
         files_to_update (list): optional list of relative paths of files 
             on which to compute and add the new data. If missing 
             all indexed files are computed.
+        journal (ChangeJournal): optional journal recording the before
+            and after data of each changed entry.
     """
     if files_to_update:
-        files = files_to_update
+        files = [normalize_path(f) for f in files_to_update]
     else:
         files = dir.files(force_refresh=True)
         dir.depopulate()
     for f in files:
-        if not file_index.has_key(f):
+        if f not in file_index:
             print("File was not in index: {}".format(f))
+            before = None
             file_index[f] = {}
+        else:
+            before = dict(file_index[f])
         file_index[f].update(compute_file(dir, f, file_idx_methods))
+        if journal is not None:
+            journal.record('files', f, before, file_index[f])
     return file_index
 
 
 def update_subdir_index(dir: Dir, subdirs_index={},
                         dir_idx_methods={},
-                        dirs_to_update=None) -> dict:
+                        dirs_to_update=None,
+                        journal=None) -> dict:
     """
     Add additional data to subdirs_index using dir_idx_methods.
     If a dir list is provided, only those dirs will be updated.
     If parsed dirs are missing from they index they are added with
     the data from dir_idx_methods.
     Existing dirs in the index are not removed if missing.
-    If data can't be computed a message is printed but the dir
+    If data can't be computed a warning is logged but the dir
     entry is added anyways.
     Args:
         subdirs_index (dict): dictionary to update. 
@@ -414,53 +1249,93 @@ def update_subdir_index(dir: Dir, subdirs_index={},
         dirs_to_update (list): optional list of relative paths of dirs 
             on which to compute and add the new data. If missing 
             all indexed dirs are computed.
+        journal (ChangeJournal): optional journal recording the before
+            and after data of each changed entry.
     """
     if dirs_to_update:
-        dirs = dirs_to_update
+        dirs = [normalize_path(d) for d in dirs_to_update]
     else:
         dirs = dir.subdirs(force_refresh=True)
         dir.depopulate()
     for d in dirs:
-        if not subdirs_index.has_key(d):
+        if d not in subdirs_index:
             print("Dir was not in index: {}".format(d))
+            before = None
             subdirs_index[d] = {}
+        else:
+            before = dict(subdirs_index[d])
         subdirs_index[d].update(compute_subdir(dir, d, dir_idx_methods))
+        if journal is not None:
+            journal.record('subdirs', d, before, subdirs_index[d])
     return subdirs_index
 
 
-def compute_file(dir: Dir, f_path, file_idx_methods) -> dict:
+def _report_error(progress: ProgressTracker, path: str, operation: str,
+                  exc: Exception) -> None:
+    """
+    Collect the error in progress if passed, log it otherwise.
+    """
+    if progress is not None:
+        progress.error(path, operation, exc)
+    else:
+        log.warning("{0} failed on {1}: {2}".format(operation, path, exc))
+
+
+def compute_file(dir: Dir, f_path, file_idx_methods,
+                 progress: ProgressTracker = None) -> dict:
     """
     Compute data for a file using idx_methods.
+    Indexers that fail are left out of the data, see _report_error.
     Args:
         f_path (str): relative path of the file.
+        file_idx_methods (dict): name / function of the indexers.
+        progress (ProgressTracker): optional, collects the errors.
     Returns:
         file_data (dict): dictionary of methodNames / generatedData
     """
     file_data = {}
+    abspath = dir.abspath(f_path)
+    observed = _observers and _clock()
+    if observed:
+        try:
+            nbytes = os.path.getsize(abspath)
+        except OSError:
+            nbytes = 0
+        _notify("stat", observed)
     for method_key in file_idx_methods:
         idx_method = file_idx_methods[method_key]
+        observed = observed and _clock()
         try:
-            file_data[method_key] = idx_method(dir.abspath(f_path))
+            file_data[method_key] = idx_method(abspath)
         except Exception as exc:
-            print(f_path, exc)
+            _report_error(progress, f_path, method_key, exc)
+        if observed:
+            _notify("file:" + method_key, observed, nbytes=nbytes)
     return file_data
 
 
-def compute_subdir(dir: Dir, d_path, dir_idx_methods) -> dict:
+def compute_subdir(dir: Dir, d_path, dir_idx_methods,
+                   progress: ProgressTracker = None) -> dict:
     """
     Compute data for a subdirectory using idx_methods.
+    Indexers that fail are left out of the data, see _report_error.
     Args:
         d_path (str): relative path of the subdir.
+        dir_idx_methods (dict): name / function of the indexers.
+        progress (ProgressTracker): optional, collects the errors.
     Returns:
         dir_data (dict): dictionary of methodNames / generatedData
     """
     dir_data = {}
     for method_key in dir_idx_methods:
         idx_method = dir_idx_methods[method_key]
+        observed = _observers and _clock()
         try:
             dir_data[method_key] = idx_method(dir.abspath(d_path))
         except Exception as exc:
-            print(d_path, exc)
+            _report_error(progress, d_path, method_key, exc)
+        if observed:
+            _notify("subdir:" + method_key, observed)
     return dir_data
 
 
@@ -469,7 +1344,11 @@ def snapshot_dir(targetDir: str,
                  ['.git/', '.hg/', '.svn/'],
                  file_indexers: List[IndexerType] =
                  [FileIndexers.XXHASH64()],
-                 dir_indexers: List[IndexerType] = []) -> DirSnapshotType:
+                 dir_indexers: List[IndexerType] = [],
+                 track_links: bool = False,
+                 progress: ProgressTracker = None,
+                 walk_workers: int = 1,
+                 ignore_files: List[str] = None) -> DirSnapshotType:
     """
     Return a snapshot dict of the passed dir path.
 
@@ -481,20 +1360,102 @@ def snapshot_dir(targetDir: str,
             Eg: {"getmtime":os.path.getmtime, "sha256":filehash}
         dir_indexers (list): name / function Tuples of indexing 
             operations to apply to the subdirectories in the folder.
+        track_links (bool): whether to index each hardlinked inode once
+            and record the groups of links in a `links' key, mapping
+            "st_dev:st_ino" to {"paths": [relative paths]}.
+        progress (ProgressTracker): optional tracker the walked and
+            indexed files and the errors are reported to. The files are
+            then stat'ed once more before indexing, for the ETA.
+        walk_workers (int): number of threads listing directories, see
+            Dir.walk_parallel.
+        ignore_files (list): names of per directory ignore files, eg.
+            ['.gitignore', '.exclude'], see Dir.
     """
-    dir = Dir(targetDir, excludes=excludes)
-    dir.populate(force_refresh=True)
+    file_indexers = dict(file_indexers)
+    dir_indexers = dict(dir_indexers)
+    dir = Dir(targetDir, excludes=excludes, ignore_files=ignore_files)
+    dir.populate(force_refresh=True, workers=walk_workers)
+    if progress is not None:
+        for f in dir.iterfiles():
+            progress.walked(f, _file_size(dir.abspath(f)))
     state = {}
-    state['root'] = {dir.path: compute_subdir(dir, ".", dir_indexers)}
-    state['subdirs'] = index_files(dir, dir_indexers)
-    state['files'] = index_subdirs(dir, file_indexers)
+    state['root'] = {dir.path: compute_subdir(dir, ".", dir_indexers,
+                                              progress)}
+    state['subdirs'] = index_subdirs(dir, dir_indexers, progress)
+    if track_links:
+        link_groups = {}
+        state['files'] = index_files(dir, file_indexers, link_groups,
+                                     progress)
+        state['links'] = dict((inode, {'paths': paths})
+                              for inode, paths in link_groups.items())
+    else:
+        state['files'] = index_files(dir, file_indexers,
+                                     progress=progress)
     dir.depopulate()
+    state = sort_snapshot(state)
+    if progress is not None:
+        progress.done()
     return state
 
 
+def index_archive_files(archive_dir: ArchiveDir,
+                        file_idx_methods={}) -> dict:
+    """
+    Generate the files indexes of an ArchiveDir hashing the member streams.
+
+    Only the idx_methods names with a FileIndexers.STREAM_HASHERS
+    counterpart can be computed, the others are left out of the data.
+
+    Returns:
+        files_index (dict): dictionary of relative file paths and 
+            associated data: 
+                Eg. relpath : {methodName : data, methodName : data}
+    """
+    names = list(dict(file_idx_methods))
+    files = set(archive_dir.iterfiles())
+    files_index = {}
+    for entry, stream in SevenZip.iter_entry_streams(archive_dir.archive_path):
+        relpath = archive_dir.member_relpath(entry.path)
+        if relpath in files:
+            files_index[relpath] = FileIndexers.hash_stream(stream, names)
+    # keep the same order as the listing, like index_files does
+    return dict((f, files_index.get(f, {})) for f in archive_dir.iterfiles())
+
+
+def snapshot_archive(archive_path: str,
+                     root: str = "",
+                     excludes: List[str] =
+                     ['.git/', '.hg/', '.svn/'],
+                     file_indexers: List[IndexerType] =
+                     [FileIndexers.XXHASH64()]) -> DirSnapshotType:
+    """
+    Return a snapshot dict of the contents of an archive, without
+    extracting it, shaped like the ones of snapshot_dir.
+
+    Subdirectories carry no data, as directory indexers need
+    the filesystem.
+
+    Args:
+        archive_path (str): Path of the target archive.
+        root (str): Path inside the archive to use as root.
+        excludes (list): List of gitignore like patters to exclude.
+        file_indexers (list): list of name / function Tuples, only the
+            names in FileIndexers.STREAM_HASHERS are computed.
+    """
+    archive_dir = ArchiveDir(archive_path, root, excludes=excludes)
+    archive_dir.populate(force_refresh=True)
+    state = {}
+    state['root'] = {archive_dir.path: {}}
+    state['subdirs'] = dict((d, {}) for d in archive_dir.itersubdirs())
+    state['files'] = index_archive_files(archive_dir, file_indexers)
+    archive_dir.depopulate()
+    return sort_snapshot(state)
+
+
 def snapshot_to_json(snapshot: dict) -> str:
     """
-    Return the json rappresentation of the passed snapshot
+    Return the json rappresentation of the passed snapshot,
+    with sorted keys so that equal snapshots give the same json.
 
     Args:
         snapshot (dict): snapshot to serialize
@@ -502,14 +1463,22 @@ def snapshot_to_json(snapshot: dict) -> str:
     Returns:
         json_data (str): json serialized snapshot
     """
-    return json.dumps(snapshot)
+    observed = _observers and _clock()
+    json_data = json.dumps(snapshot, sort_keys=True)
+    if observed:
+        _notify("json_dump", observed, nbytes=len(json_data))
+    return json_data
 
 
 def json_to_snapshot(json_data: str) -> dict:
     """
     Return the snapshot parsed from passed json data.
     """
-    return json.loads(json_data)
+    observed = _observers and _clock()
+    snapshot = json.loads(json_data)
+    if observed:
+        _notify("json_load", observed, nbytes=len(json_data))
+    return snapshot
 
 
 def json_file_to_snapshot(self, json_path: str) -> dict:
@@ -546,9 +1515,9 @@ def compare_entry(new_data: IndexedDataType,
             if new_data[cmp_key] != old_data[cmp_key]:
                 # modified
                 return 1
-            else:
-                # unknown
-                return -1
+        else:
+            # unknown
+            return -1
     else:
         methods = old_data.keys() & new_data.keys()
         if len(methods) == 0:
@@ -585,7 +1554,10 @@ def compare_dir_snapshot(dir_snapshot_new: DirSnapshotType,
             - modified files `modified`
             - unknown modified state `modified_unknown`
             - deleted directories `deleted_dirs`
+            - files whose hardlinks changed `links_changed`, only if
+              both snapshots track links.
 
+        Each list is sorted.
     """
     old_files = dir_snapshot_old['files'].keys()
     new_files = dir_snapshot_new['files'].keys()
@@ -593,13 +1565,13 @@ def compare_dir_snapshot(dir_snapshot_new: DirSnapshotType,
     new_dirs = dir_snapshot_new['subdirs'].keys()
 
     data = {}
-    data['deleted'] = list(old_files - new_files)
-    data['created'] = list(new_files - old_files)
+    data['deleted'] = sorted(old_files - new_files)
+    data['created'] = sorted(new_files - old_files)
     data['modified'] = []
     data['modified_unknown'] = []
-    data['deleted_dirs'] = list(old_dirs - new_dirs)
+    data['deleted_dirs'] = sorted(old_dirs - new_dirs)
 
-    for f in old_files & new_files:
+    for f in sorted(old_files & new_files):
         cmp_res = compare_entry(dir_snapshot_new['files'][f],
                                 dir_snapshot_old['files'][f],
                                 cmp_key)
@@ -609,4 +1581,35 @@ def compare_dir_snapshot(dir_snapshot_new: DirSnapshotType,
             pass
         if cmp_res == -1:
             data['modified_unknown'].append(f)
+    if 'links' in dir_snapshot_new and 'links' in dir_snapshot_old:
+        data['links_changed'] = compare_links(dir_snapshot_new,
+                                              dir_snapshot_old)
     return data
+
+
+def _linked_paths(dir_snapshot: DirSnapshotType) -> Dict[str, frozenset]:
+    """
+    Return relative path / all the paths linked to it (itself included).
+    """
+    linked = {}
+    for group in dir_snapshot['links'].values():
+        paths = frozenset(group['paths'])
+        for path in paths:
+            linked[path] = paths
+    return linked
+
+
+def compare_links(dir_snapshot_new: DirSnapshotType,
+                  dir_snapshot_old: DirSnapshotType) -> List[str]:
+    """
+    Return the files present in both snapshots whose set of hardlinks
+    changed: linked, unlinked or linked to different files.
+
+    Inode numbers are not compared, only which paths share one.
+    """
+    new_linked = _linked_paths(dir_snapshot_new)
+    old_linked = _linked_paths(dir_snapshot_old)
+    common = dir_snapshot_new['files'].keys() & dir_snapshot_old['files'].keys()
+    no_links = frozenset()
+    return [f for f in sorted(common)
+            if new_linked.get(f, no_links) != old_linked.get(f, no_links)]
@@ -24,6 +24,8 @@
 import os
 import re
 import subprocess
+import threading
+from collections import deque
 
 from . import bass
 from .bolt import startupinfo, GPath, deprint, walkdir
@@ -108,6 +110,154 @@ def extract7z(src_archive, extract_dir, progress=None, readExtensions=None,
                          % (source_archive, str(returncode), errorLine))
     return subArchives
 
+class ArchiveJob(object):
+    """A single extract7z or compress7z run queued in an ArchiveScheduler.
+
+    cpu is the number of cpu budget units the job holds while running, eg.
+    the -mmt thread count passed to 7z for a compression."""
+
+    def __init__(self, kind, args, kwargs, cpu=1, parent=None):
+        self.kind = kind # u'extract' or u'compress'
+        self.args = args
+        self.kwargs = kwargs
+        self.cpu = cpu
+        self.parent = parent # job which extracted this sub archive
+        self.index = 0 # progress: files processed so far
+        self.full = 0 # progress: files expected, 0 if unknown
+        self.result = None
+        self.error = None
+
+    @property
+    def name(self):
+        archive = self.args[0] if self.kind == u'extract' else self.args[2]
+        return archive.s
+
+    def __repr__(self):
+        return u'ArchiveJob(%s, %s)' % (self.kind, self.name)
+
+class _JobProgress(object):
+    """Progress adapter passed to extract7z/compress7z, forwards the lines
+    matched by regExtractMatch/regCompressMatch to the scheduler."""
+
+    def __init__(self, job, callback):
+        self.job = job
+        self.callback = callback
+
+    def __call__(self, index, msg):
+        self.job.index = index
+        if self.callback is not None:
+            self.callback(self.job, index, self.job.full, msg)
+
+    def setFull(self, full):
+        self.job.full = full
+
+class ArchiveScheduler(object):
+    """Run many 7z extractions and compressions concurrently.
+
+    At most io_budget jobs run at once, and their cpu units never exceed
+    cpu_budget. Sub archives found by recursive extractions (extract7z
+    subArchives) are extracted next to them by new jobs fed back into the
+    same queue. progress, if given, is called as
+    progress(job, index, full, msg) from the worker threads."""
+
+    def __init__(self, cpu_budget=None, io_budget=4, progress=None,
+                 readExtensions=None):
+        self.cpu_budget = max(1, cpu_budget or os.cpu_count() or 1)
+        self.io_budget = max(1, io_budget)
+        self.progress = progress
+        self.readExtensions = readExtensions
+        self.jobs = []
+        self._queue = deque()
+        self._unfinished = 0
+        self._cpu_used = 0
+        self._lock = threading.Condition()
+
+    def add_extract(self, src_archive, extract_dir, recursive=False,
+                    filelist_to_extract=None, cpu=1, parent=None):
+        job = ArchiveJob(u'extract', (src_archive, extract_dir),
+                         {u'recursive': recursive,
+                          u'filelist_to_extract': filelist_to_extract},
+                         cpu, parent)
+        self._put(job)
+        return job
+
+    def add_compress(self, command, outDir, destArchive, srcDir, cpu=1):
+        job = ArchiveJob(u'compress', (command, outDir, destArchive, srcDir),
+                         {}, cpu)
+        self._put(job)
+        return job
+
+    def _put(self, job):
+        with self._lock:
+            self.jobs.append(job)
+            self._queue.append(job)
+            self._unfinished += 1
+            self._lock.notify_all()
+
+    def run(self):
+        """Run all the queued jobs and the ones they spawn, return the list
+        of failed jobs, whose error attribute holds the StateError or the
+        other exception raised by the job."""
+        workers = [threading.Thread(target=self._work)
+                   for _ in range(self.io_budget)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return [job for job in self.jobs if job.error is not None]
+
+    def _next(self):
+        """Wait for a job fitting in the cpu budget, None when all done."""
+        with self._lock:
+            while True:
+                if not self._unfinished:
+                    return None
+                for job in self._queue:
+                    cpu = min(job.cpu, self.cpu_budget)
+                    if self._cpu_used + cpu <= self.cpu_budget:
+                        self._queue.remove(job)
+                        self._cpu_used += cpu
+                        return job
+                self._lock.wait()
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            try:
+                self._run_job(job)
+            except Exception as e:
+                # eg. 7z missing (OSError) or undecodable output: fail the
+                # job, not the worker
+                job.error = e
+                if not isinstance(e, StateError):
+                    deprint(u'%r failed' % job, traceback=True)
+            finally:
+                with self._lock:
+                    self._cpu_used -= min(job.cpu, self.cpu_budget)
+                    self._unfinished -= 1
+                    self._lock.notify_all()
+
+    def _run_job(self, job):
+        progress = _JobProgress(job, self.progress)
+        if job.kind == u'compress':
+            command, outDir, destArchive, srcDir = job.args
+            job.result = compress7z(command, outDir, destArchive, srcDir,
+                                    progress=progress)
+            return
+        src_archive, extract_dir = job.args
+        job.result = extract7z(src_archive, extract_dir, progress=progress,
+            readExtensions=self.readExtensions, **job.kwargs)
+        for sub_archive in job.result or ():
+            # queued before this job counts as finished, so run() can't
+            # return while sub archives are still pending
+            self.add_extract(extract_dir.join(sub_archive),
+                             extract_dir.join(sub_archive.root),
+                             recursive=job.kwargs[u'recursive'],
+                             cpu=job.cpu, parent=job)
+
 def wrapPopenOut(command, wrapper, errorMsg):
     proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=-1,
                             stdin=subprocess.PIPE, startupinfo=startupinfo)
@@ -0,0 +1,295 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List
+import gzip
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from collections import deque
+
+from Snapshot import Dir, DirSnapshotType, compare_dir_snapshot
+from sevenzip import _extraction_target, is_safe_member
+
+# Member holding the list of deletions of a delta archive, always first.
+DELTA_MANIFEST = '.dirdiff-delta.json'
+
+
+class ParallelGzipWriter(object):
+    """
+    Write only file object compressing to gzip on several threads.
+
+    Data is cut in blocks which are compressed independently, pigz
+    style, each one as a complete gzip member. A concatenation of gzip
+    members is a valid gzip file, readable by gzip and the usual tools.
+    tarfile's stream modes ('r|gz', 'r|*') only decode the first member
+    though: read it through gzip.GzipFile, as restore_archive does.
+    zlib releases the GIL while compressing, so blocks are compressed in
+    parallel.
+
+    Args:
+        fileobj: binary file object to write the compressed data to.
+        workers (int): number of compression threads, cpu count by default.
+        blocksize (int): uncompressed size of each independent block.
+        compresslevel (int): gzip compression level.
+    """
+
+    def __init__(self, fileobj, workers: int = None,
+                 blocksize: int = 4194304, compresslevel: int = 6):
+        self.fileobj = fileobj
+        self.workers = workers or os.cpu_count() or 1
+        self.blocksize = blocksize
+        self.compresslevel = compresslevel
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(self.workers)
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.blocksize:
+            self._submit(bytes(self._buffer[:self.blocksize]))
+            del self._buffer[:self.blocksize]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append(self._executor.submit(
+            gzip.compress, block, self.compresslevel, mtime=0))
+        # bound memory: keep at most two blocks in flight per worker
+        while len(self._pending) > 2 * self.workers:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def flush(self) -> None:
+        """
+        Compress what is buffered and write all the pending blocks.
+        """
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.flush()
+        self._executor.shutdown()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_tar(archive_path: str, root_path: str,
+              files: Iterable[str], subdirs: Iterable[str] = (),
+              workers: int = None, compresslevel: int = 6,
+              manifest: dict = None) -> str:
+    """
+    Write a gzipped tar of the listed paths, relative to root_path.
+
+    Members are streamed one at a time, without walking root_path again,
+    and compressed by a ParallelGzipWriter.
+
+    Args:
+        archive_path (str): Path of the archive, if None a tempfile
+            is created.
+        files (list): relative paths of the files to add.
+        subdirs (list): relative paths of the directories to add, needed
+            only to keep empty ones.
+        manifest (dict): if set, written as json to a DELTA_MANIFEST
+            first member.
+
+    Returns:
+        the archive path.
+    """
+    if archive_path is None:
+        fd, archive_path = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+    with open(archive_path, 'wb') as f, \
+            ParallelGzipWriter(f, workers,
+                               compresslevel=compresslevel) as gz, \
+            tarfile.open(fileobj=gz, mode='w|') as tar:
+        if manifest is not None:
+            data = json.dumps(manifest).encode('utf-8')
+            info = tarfile.TarInfo(DELTA_MANIFEST)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        for d in subdirs:
+            tar.add(os.path.join(root_path, d),
+                    arcname=d.replace(os.sep, '/'), recursive=False)
+        for f_path in files:
+            tar.add(os.path.join(root_path, f_path),
+                    arcname=f_path.replace(os.sep, '/'), recursive=False)
+    return archive_path
+
+
+def snapshot_root(snapshot: DirSnapshotType) -> str:
+    """
+    Return the root path of a snapshot.
+    """
+    return next(iter(snapshot['root']))
+
+
+def compress_snapshot(snapshot: DirSnapshotType, archive_path: str = None,
+                      root_path: str = None, workers: int = None,
+                      compresslevel: int = 6) -> str:
+    """
+    Compress the files and subdirs of a snapshot to a gzipped tar.
+
+    The snapshot already holds the walked and filtered paths,
+    so the directory is not walked again.
+
+    Args:
+        snapshot (dict): snapshot as returned by snapshot_dir.
+        archive_path (str): Path of the archive, if None a tempfile
+            is created.
+        root_path (str): directory the snapshot paths are relative to,
+            the snapshot root by default.
+
+    Returns:
+        the archive path.
+    """
+    return write_tar(archive_path, root_path or snapshot_root(snapshot),
+                     snapshot['files'], snapshot['subdirs'],
+                     workers, compresslevel)
+
+
+def compress_dir(dir: Dir, archive_path: str = None, workers: int = None,
+                 compresslevel: int = 6) -> str:
+    """
+    Compress the not excluded contents of a Dir to a gzipped tar,
+    using the cached listing if the Dir is already populated.
+
+    Returns:
+        the archive path.
+    """
+    return write_tar(archive_path, dir.path, dir.iterfiles(),
+                     dir.itersubdirs(), workers, compresslevel)
+
+
+def write_delta_archive(new_snapshot: DirSnapshotType,
+                        old_snapshot: DirSnapshotType,
+                        archive_path: str = None, root_path: str = None,
+                        cmp_key: str = None, workers: int = None,
+                        compresslevel: int = 6) -> str:
+    """
+    Write an incremental archive bringing old_snapshot to new_snapshot.
+
+    It contains the created, modified and modified_unknown files of
+    compare_dir_snapshot(new_snapshot, old_snapshot), the new subdirs,
+    and a DELTA_MANIFEST listing the deleted files and dirs.
+
+    Args:
+        root_path (str): directory holding the new contents,
+            the new_snapshot root by default.
+        cmp_key (str): passed on to compare_dir_snapshot.
+
+    Returns:
+        the archive path.
+    """
+    diff = compare_dir_snapshot(new_snapshot, old_snapshot, cmp_key)
+    files = diff['created'] + diff['modified'] + diff['modified_unknown']
+    created_dirs = [d for d in new_snapshot['subdirs']
+                    if d not in old_snapshot['subdirs']]
+    manifest = {
+        'deleted': [f.replace(os.sep, '/') for f in diff['deleted']],
+        'deleted_dirs': [d.replace(os.sep, '/')
+                         for d in diff['deleted_dirs']],
+    }
+    return write_tar(archive_path, root_path or snapshot_root(new_snapshot),
+                     files, created_dirs, workers, compresslevel, manifest)
+
+
+def _extract_member(tar: tarfile.TarFile, info: tarfile.TarInfo,
+                    target_dir: str) -> None:
+    if hasattr(tarfile, 'data_filter'):
+        tar.extract(info, target_dir, filter='data')
+    else:
+        tar.extract(info, target_dir)
+
+
+def restore_archive(archive_path: str, target_dir: str) -> None:
+    """
+    Apply a full or delta archive onto target_dir.
+
+    The deletions listed in a delta manifest are applied before
+    extracting its files. A manifest listing a path outside of
+    target_dir raises ValueError before anything is deleted.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    # ParallelGzipWriter writes one gzip member per block and tarfile's
+    # 'r|gz' stream mode only decodes the first one, gzip reads them all
+    with gzip.open(archive_path, 'rb') as gz, \
+            tarfile.open(fileobj=gz, mode='r|') as tar:
+        for info in tar:
+            if info.name == DELTA_MANIFEST:
+                manifest = json.loads(
+                    tar.extractfile(info).read().decode('utf-8'))
+                _apply_deletions(manifest, target_dir)
+            else:
+                _extract_member(tar, info, target_dir)
+
+
+def _deletion_target(target_dir: str, relpath: str) -> str:
+    """
+    Return the path of relpath in target_dir, raise ValueError if it is
+    unsafe or its parent resolves outside of target_dir. The entry
+    itself may be a symlink, it is removed, not followed.
+    """
+    if not is_safe_member(relpath):
+        raise ValueError("Unsafe path in delta manifest: {0}".format(
+            relpath))
+    parent = os.path.dirname(relpath)
+    if parent:
+        _extraction_target(target_dir, parent)
+    return os.path.join(target_dir, relpath.replace('/', os.sep))
+
+
+def _apply_deletions(manifest: dict, target_dir: str) -> None:
+    files = [_deletion_target(target_dir, f)
+             for f in manifest.get('deleted', [])]
+    # deepest first, a deleted parent takes its deleted children with it
+    dirs = [_deletion_target(target_dir, d)
+            for d in sorted(manifest.get('deleted_dirs', []), reverse=True)]
+    for path in files:
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
+    for path in dirs:
+        if os.path.islink(path):
+            os.remove(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def restore_chain(archive_paths: List[str], target_dir: str) -> None:
+    """
+    Restore a backup chain onto target_dir: a full archive followed by
+    the delta archives written since, in order.
+    """
+    for archive_path in archive_paths:
+        restore_archive(archive_path, target_dir)
@@ -0,0 +1,268 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from Snapshot import (Dir, FileIndexers, compare_dir_snapshot,
+                      json_to_snapshot, snapshot_dir, snapshot_to_json)
+
+log = logging.getLogger("benchmark")
+
+
+class TreeSpec(NamedTuple):
+    """
+    Shape of a synthetic tree.
+
+    files: number of files, spread evenly over the directories.
+    depth: levels of directories under the root.
+    fanout: subdirectories per directory.
+    sizes: file sizes in bytes, picked with the matching weights.
+    excluded: fraction of the files named *.tmp, plus one cache/
+        directory per top level directory, matched by EXCLUDES.
+    seed: seed of the names, sizes and contents.
+    """
+    files: int = 2000
+    depth: int = 3
+    fanout: int = 4
+    sizes: Tuple[int, ...] = (0, 1024, 16384, 262144, 4194304)
+    weights: Tuple[float, ...] = (0.05, 0.5, 0.3, 0.14, 0.01)
+    excluded: float = 0.1
+    seed: int = 0
+
+
+EXCLUDES = ['.git/', '.hg/', '.svn/', '*.tmp', 'cache/']
+
+
+def generate_tree(path: str, spec: TreeSpec) -> Dict[str, int]:
+    """
+    Create the synthetic tree described by spec in path.
+
+    The same spec always gives the same tree.
+
+    Returns:
+        dict with the number of `files', `dirs' and `bytes' written.
+    """
+    rng = random.Random(spec.seed)
+    dirs = ['']
+    level = ['']
+    for depth in range(spec.depth):
+        level = [os.path.join(parent, 'd{0}_{1}'.format(depth, i))
+                 for parent in level for i in range(spec.fanout)]
+        dirs.extend(level)
+    dirs.extend(os.path.join(d, 'cache') for d in dirs
+                if d and os.sep not in d)
+    for d in dirs:
+        os.makedirs(os.path.join(path, d), exist_ok=True)
+
+    written = 0
+    for i in range(spec.files):
+        d = dirs[i % len(dirs)]
+        ext = '.tmp' if rng.random() < spec.excluded else '.bin'
+        size = rng.choices(spec.sizes, spec.weights)[0]
+        with open(os.path.join(path, d, 'f{0}{1}'.format(i, ext)), 'wb') as f:
+            f.write(rng.randbytes(size))
+        written += size
+    return {'files': spec.files, 'dirs': len(dirs), 'bytes': written}
+
+
+def measure(func: Callable[[], Any], repeat: int = 3) -> Dict[str, Any]:
+    """
+    Call func repeat times.
+
+    Returns:
+        dict with the `min', `median' and `max' wall times in seconds,
+        and the `result' of the last call.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times),
+            'max': max(times), 'result': result}
+
+
+def _walk(dir: Dir) -> int:
+    count = 0
+    for _, dirs, files in dir.walk():
+        count += len(dirs) + len(files)
+    return count
+
+
+def _populate(dir: Dir) -> int:
+    dir.populate(force_refresh=True)
+    return len(dir._files_cache) + len(dir._sub_dirs_cache)
+
+
+def _hash_all(func: Callable[[str], str], paths: List[str]) -> int:
+    total = 0
+    for path in paths:
+        func(path)
+        total += os.path.getsize(path)
+    return total
+
+
+def _modified_copy(snapshot: dict, fraction: float, seed: int) -> dict:
+    """
+    Return a copy of snapshot with a fraction of its files modified,
+    deleted or created, as an older snapshot to diff against.
+    """
+    rng = random.Random(seed)
+    old = copy.deepcopy(snapshot)
+    for path in list(old['files']):
+        draw = rng.random()
+        if draw < fraction / 3:
+            del old['files'][path]
+        elif draw < fraction * 2 / 3:
+            old['files'][path] = dict(
+                (k, '0' * 16) for k in old['files'][path])
+        elif draw < fraction:
+            old['files'][path + '.old'] = dict(old['files'][path])
+    return old
+
+
+def run_benchmarks(path: str, spec: TreeSpec,
+                   repeat: int = 3) -> Dict[str, Any]:
+    """
+    Measure the hot paths on the tree generated from spec in path.
+
+    Each phase is measured on its own: Dir.walk, Dir.populate, the
+    hashing throughput of each FileIndexers hasher, snapshot_dir, the
+    json round trip and compare_dir_snapshot. Files are read from the
+    page cache after the first run, use repeat=1 on a dropped cache to
+    measure cold reads.
+
+    Returns:
+        dict with the run `env', the `spec', the `tree' written and the
+        `results' of each phase, times in seconds.
+    """
+    tree = generate_tree(path, spec)
+    results = {}
+
+    dir = Dir(path, excludes=EXCLUDES)
+    res = measure(lambda: _walk(dir), repeat)
+    res['entries'] = res.pop('result')
+    results['walk'] = res
+
+    res = measure(lambda: _populate(dir), repeat)
+    res['entries'] = res.pop('result')
+    results['populate'] = res
+
+    paths = dir.files(abspath=True)
+    for name, func in (FileIndexers.XXHASH64(), FileIndexers.SHA256()):
+        res = measure(lambda: _hash_all(func, paths), repeat)
+        res['bytes'] = res.pop('result')
+        res['mb_per_s'] = res['bytes'] / res['median'] / 1e6
+        results['hash_' + name] = res
+
+    res = measure(lambda: snapshot_dir(path, excludes=EXCLUDES), repeat)
+    snapshot = res.pop('result')
+    res['files'] = len(snapshot['files'])
+    results['snapshot_dir'] = res
+
+    res = measure(lambda: snapshot_to_json(snapshot), repeat)
+    data = res.pop('result')
+    res['bytes'] = len(data)
+    results['json_dump'] = res
+    res = measure(lambda: json_to_snapshot(data), repeat)
+    del res['result']
+    results['json_load'] = res
+
+    old = _modified_copy(snapshot, 0.1, spec.seed)
+    res = measure(lambda: compare_dir_snapshot(snapshot, old, 'xxhash'),
+                  repeat)
+    res['changes'] = sum(len(v) for v in res.pop('result').values())
+    results['compare_dir_snapshot'] = res
+
+    return {
+        'env': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'spec': spec._asdict(),
+        'tree': tree,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def write_results(results: Dict[str, Any], output_path: str) -> None:
+    """
+    Append results as one json line to output_path, so the runs of a
+    file can be compared over time.
+    """
+    with open(output_path, 'a') as f:
+        f.write(json.dumps(results, sort_keys=True) + '\n')
+
+
+def main(argv: List[str] = None) -> int:
+    defaults = TreeSpec()
+    parser = argparse.ArgumentParser(
+        description="Benchmark walking, hashing, snapshotting and diffing "
+                    "a synthetic tree.")
+    parser.add_argument('--files', type=int, default=defaults.files)
+    parser.add_argument('--depth', type=int, default=defaults.depth)
+    parser.add_argument('--fanout', type=int, default=defaults.fanout)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(defaults.sizes))
+    parser.add_argument('--weights', type=float, nargs='+',
+                        default=list(defaults.weights))
+    parser.add_argument('--excluded', type=float, default=defaults.excluded)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dir', help="where to generate the tree, "
+                        "a temporary directory removed afterwards by default")
+    parser.add_argument('--output', default='benchmark.jsonl',
+                        help="json lines file the results are appended to")
+    args = parser.parse_args(argv)
+    if len(args.sizes) != len(args.weights):
+        parser.error("--sizes and --weights must have the same length")
+
+    spec = TreeSpec(args.files, args.depth, args.fanout, tuple(args.sizes),
+                    tuple(args.weights), args.excluded, args.seed)
+    path = args.dir or tempfile.mkdtemp(prefix='dirdiff-bench-')
+    try:
+        results = run_benchmarks(path, spec, args.repeat)
+    finally:
+        if not args.dir:
+            shutil.rmtree(path, ignore_errors=True)
+    write_results(results, args.output)
+    for phase, res in results['results'].items():
+        print("{0:<22} {1:9.4f}s".format(phase, res['median']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
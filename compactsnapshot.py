@@ -0,0 +1,345 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from array import array
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import bisect
+import sys
+
+from Snapshot import DirSnapshotType, IndexType, compare_links, sort_snapshot
+
+# marks a row without value in a column
+_MISSING = object()
+
+
+def _is_hex64(value: Any) -> bool:
+    """
+    Return whether value is a 16 digits lowercase hex string, like the
+    xxhash indexer values, which then fits in an unsigned 64 bit int.
+    """
+    if type(value) is not str or len(value) != 16:
+        return False
+    try:
+        return format(int(value, 16), '016x') == value
+    except ValueError:
+        return False
+
+
+def _split_path(path: str) -> Tuple[str, str]:
+    """
+    Split path in its directory prefix, with the trailing separator, and
+    its name.
+    """
+    cut = max(path.rfind('/'), path.rfind('\\')) + 1
+    return path[:cut], path[cut:]
+
+
+class _Column(object):
+    """
+    Values of one indexer for all the rows of a CompactIndex.
+
+    Hex digests are kept as uint64, floats as doubles, ints as int64,
+    anything else in a plain list. present marks the rows having a value.
+    """
+
+    __slots__ = ['kind', 'values', 'present']
+
+    def __init__(self, values: List[Any]):
+        self.present = bytearray(0 if v is _MISSING else 1 for v in values)
+        actual = [v for v in values if v is not _MISSING]
+        if actual and all(_is_hex64(v) for v in actual):
+            self.kind = 'hex64'
+            self.values = array('Q', (0 if v is _MISSING else int(v, 16)
+                                      for v in values))
+        elif actual and all(type(v) is float for v in actual):
+            self.kind = 'float'
+            self.values = array('d', (0.0 if v is _MISSING else v
+                                      for v in values))
+        elif actual and all(type(v) is int and -2**63 <= v < 2**63
+                            for v in actual):
+            self.kind = 'int'
+            self.values = array('q', (0 if v is _MISSING else v
+                                      for v in values))
+        else:
+            self.kind = 'object'
+            self.values = [None if v is _MISSING else v for v in values]
+
+    def get(self, row: int) -> Any:
+        value = self.values[row]
+        if self.kind == 'hex64':
+            return format(value, '016x')
+        return value
+
+
+class EntryView(Mapping):
+    """
+    Read only mapping of indexer name / value of one CompactIndex row,
+    usable wherever the entry dicts of a snapshot are.
+    """
+
+    __slots__ = ['_index', '_row']
+
+    def __init__(self, index: 'CompactIndex', row: int):
+        self._index = index
+        self._row = row
+
+    def __getitem__(self, name: str) -> Any:
+        column = self._index._columns.get(name)
+        if column is None or not column.present[self._row]:
+            raise KeyError(name)
+        return column.get(self._row)
+
+    def __iter__(self) -> Iterator[str]:
+        for name, column in self._index._columns.items():
+            if column.present[self._row]:
+                yield name
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class CompactIndex(Mapping):
+    """
+    Memory compact, read only, version of a snapshot index.
+
+    Paths are split in an interned directory prefix, stored once for all
+    the entries in that directory, and a name. Rows are sorted by prefix
+    then name and the data is stored by column, one per indexer, see
+    _Column. Lookups find the rows of the prefix and bisect their names.
+
+    Behaves like the relative path / data dict it is built from, so
+    compare_dir_snapshot works on it unchanged.
+    """
+
+    def __init__(self, index: IndexType):
+        split = sorted(_split_path(path) for path in index)
+        self._prefix_ids: Dict[str, int] = {}
+        self._prefixes: List[str] = []
+        self._bounds = array('I')
+        self._names: List[str] = []
+        for row, (prefix, name) in enumerate(split):
+            if prefix not in self._prefix_ids:
+                prefix = sys.intern(prefix)
+                self._prefix_ids[prefix] = len(self._prefixes)
+                self._prefixes.append(prefix)
+                self._bounds.append(row)
+            self._names.append(sys.intern(name))
+        self._bounds.append(len(split))
+        paths = [prefix + name for prefix, name in split]
+        indexers = []
+        for data in index.values():
+            for name in data:
+                if name not in indexers:
+                    indexers.append(name)
+        self._columns: Dict[str, _Column] = dict(
+            (name, _Column([index[p].get(name, _MISSING) for p in paths]))
+            for name in indexers)
+
+    def _row(self, path: str) -> int:
+        prefix, name = _split_path(path)
+        prefix_id = self._prefix_ids.get(prefix)
+        if prefix_id is None:
+            return -1
+        hi = self._bounds[prefix_id + 1]
+        row = bisect.bisect_left(self._names, name,
+                                 self._bounds[prefix_id], hi)
+        if row < hi and self._names[row] == name:
+            return row
+        return -1
+
+    def __getitem__(self, path: str) -> EntryView:
+        row = self._row(path) if isinstance(path, str) else -1
+        if row < 0:
+            raise KeyError(path)
+        return EntryView(self, row)
+
+    def __contains__(self, path) -> bool:
+        return isinstance(path, str) and self._row(path) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        for prefix, name, _ in self.rows():
+            yield prefix + name
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def column(self, name: str) -> Optional[_Column]:
+        """
+        Return the values of the indexer name, None if no entry has one.
+        """
+        return self._columns.get(name)
+
+    def column_names(self) -> List[str]:
+        return list(self._columns)
+
+    def prefix_ranges(self) -> Iterator[Tuple[str, int, int]]:
+        """
+        Yield each directory prefix with its first row and end row.
+        """
+        for prefix_id, prefix in enumerate(self._prefixes):
+            yield (prefix, self._bounds[prefix_id],
+                   self._bounds[prefix_id + 1])
+
+    def names(self, start: int, end: int) -> List[str]:
+        """
+        Return the interned names of the rows from start to end.
+        """
+        return self._names[start:end]
+
+    def path(self, row: int) -> str:
+        """
+        Return the path of a row.
+        """
+        prefix_id = bisect.bisect_right(self._bounds, row) - 1
+        return self._prefixes[prefix_id] + self._names[row]
+
+    def rows(self) -> Iterator[Tuple[str, str, int]]:
+        """
+        Yield the prefix, name and row of the entries, in row order.
+        """
+        names = self._names
+        for prefix_id, prefix in enumerate(self._prefixes):
+            for row in range(self._bounds[prefix_id],
+                             self._bounds[prefix_id + 1]):
+                yield prefix, names[row], row
+
+    def to_dict(self) -> IndexType:
+        """
+        Return the plain dict version of the index.
+        """
+        return dict((path, dict(self[path])) for path in self)
+
+
+def compact_snapshot(snapshot: DirSnapshotType) -> DirSnapshotType:
+    """
+    Return a copy of snapshot with CompactIndex files and subdirs.
+    """
+    compact = dict(snapshot)
+    compact['files'] = CompactIndex(snapshot['files'])
+    compact['subdirs'] = CompactIndex(snapshot['subdirs'])
+    return compact
+
+
+def expand_snapshot(snapshot: DirSnapshotType) -> DirSnapshotType:
+    """
+    Return a copy of a compact snapshot with plain dict indexes,
+    eg. to serialize it with snapshot_to_json.
+    """
+    expanded = dict(snapshot)
+    for key in ('files', 'subdirs'):
+        if isinstance(snapshot[key], CompactIndex):
+            expanded[key] = snapshot[key].to_dict()
+    return sort_snapshot(expanded)
+
+
+def _compare_rows(new: CompactIndex, new_row: int,
+                  old: CompactIndex, old_row: int,
+                  cmp_key: str = None) -> int:
+    """
+    compare_entry for two CompactIndex rows, on the column values.
+    """
+    if cmp_key:
+        names = [cmp_key]
+    else:
+        names = new._columns.keys() & old._columns.keys()
+    known = False
+    for name in names:
+        new_col = new._columns.get(name)
+        old_col = old._columns.get(name)
+        if (new_col is None or old_col is None
+                or not new_col.present[new_row]
+                or not old_col.present[old_row]):
+            continue
+        known = True
+        if new_col.kind == old_col.kind:
+            modified = new_col.values[new_row] != old_col.values[old_row]
+        else:
+            modified = new_col.get(new_row) != old_col.get(old_row)
+        if modified:
+            return 1
+    return 0 if known else -1
+
+
+def _merge_rows(new: CompactIndex, old: CompactIndex):
+    """
+    Yield the path, new row and old row of the entries of both indexes,
+    the row being None when the entry is missing from that index.
+    """
+    new_rows = new.rows()
+    old_rows = old.rows()
+    new_entry = next(new_rows, None)
+    old_entry = next(old_rows, None)
+    while new_entry is not None or old_entry is not None:
+        if old_entry is None or (new_entry is not None
+                                 and new_entry[:2] < old_entry[:2]):
+            yield new_entry[0] + new_entry[1], new_entry[2], None
+            new_entry = next(new_rows, None)
+        elif new_entry is None or old_entry[:2] < new_entry[:2]:
+            yield old_entry[0] + old_entry[1], None, old_entry[2]
+            old_entry = next(old_rows, None)
+        else:
+            yield new_entry[0] + new_entry[1], new_entry[2], old_entry[2]
+            new_entry = next(new_rows, None)
+            old_entry = next(old_rows, None)
+
+
+def compare_compact_snapshot(dir_snapshot_new: DirSnapshotType,
+                             dir_snapshot_old: DirSnapshotType,
+                             cmp_key: str = None) -> dict:
+    """
+    compare_dir_snapshot for two compact snapshots.
+
+    Walks the sorted rows of both snapshots side by side and compares
+    the column values directly, instead of looking up every path.
+
+    Returns:
+        the same dict as compare_dir_snapshot.
+    """
+    new_files = dir_snapshot_new['files']
+    old_files = dir_snapshot_old['files']
+    data = {'deleted': [], 'created': [], 'modified': [],
+            'modified_unknown': [], 'deleted_dirs': []}
+    for path, new_row, old_row in _merge_rows(new_files, old_files):
+        if new_row is None:
+            data['deleted'].append(path)
+        elif old_row is None:
+            data['created'].append(path)
+        else:
+            cmp_res = _compare_rows(new_files, new_row,
+                                    old_files, old_row, cmp_key)
+            if cmp_res == 1:
+                data['modified'].append(path)
+            elif cmp_res == -1:
+                data['modified_unknown'].append(path)
+    for path, new_row, _ in _merge_rows(dir_snapshot_new['subdirs'],
+                                        dir_snapshot_old['subdirs']):
+        if new_row is None:
+            data['deleted_dirs'].append(path)
+    if 'links' in dir_snapshot_new and 'links' in dir_snapshot_old:
+        data['links_changed'] = compare_links(dir_snapshot_new,
+                                              dir_snapshot_old)
+    # rows are by directory then name, not in plain path order
+    for paths in data.values():
+        paths.sort()
+    return data
@@ -25,6 +25,7 @@ expressions.
 from __future__ import absolute_import
 
 import re
+import fnmatch
 import logging
 
 logger = logging.getLogger("globster")
@@ -320,7 +321,7 @@ class ExceptionGlobster(object):
     that apply under paths specified by '!' exception patterns.
     """
     
-    def __init__(self,patterns, debug):
+    def __init__(self, patterns, debug=False):
         ignores = [[], [], []]
         for p in patterns:
             if p.startswith('!!'):
@@ -329,7 +330,20 @@ class ExceptionGlobster(object):
                 ignores[1].append(p[1:])
             else:
                 ignores[0].append(p)
+        self._exceptions = [normalize_pattern(p) for p in ignores[1]]
         self._ignores = [Globster(i, debug) for i in ignores]
+        # (excludes, globster) for each run of consecutive ignore or
+        # exception patterns, in file order, for excluded()
+        self._runs = []
+        for p in patterns:
+            excludes = p.startswith('!!') or not p.startswith('!')
+            pattern = p[2:] if p.startswith('!!') else p.lstrip('!')
+            if self._runs and self._runs[-1][0] == excludes:
+                self._runs[-1][1].append(pattern)
+            else:
+                self._runs.append((excludes, [pattern]))
+        self._runs = [(excludes, Globster(run, debug))
+                      for excludes, run in self._runs]
         
     def match(self, filename):
         """Searches for a pattern that matches the given filename.
@@ -347,6 +361,54 @@ class ExceptionGlobster(object):
             #print("Normal match")
             return self._ignores[0].match(filename)
 
+    def excluded(self, filename):
+        """Return the exclusion state of filename.
+
+        Unlike match() this follows gitignore semantics: the patterns
+        are evaluated in order and the last one matching decides, '!!'
+        patterns being plain ignores. It also tells apart a filename
+        re-included by an exception pattern from one no pattern knows
+        about, which is needed to stack several ExceptionGlobsters.
+
+        :return True if excluded, False if re-included by an exception
+            pattern, None if no pattern matches.
+        """
+        for excludes, globster in reversed(self._runs):
+            if globster.match(filename):
+                return excludes
+        return None
+
+    def has_exceptions(self):
+        """Return True if there are '!' exception patterns."""
+        return bool(self._exceptions)
+
+    def may_reinclude_under(self, dirname):
+        """Return True if an exception pattern could match below dirname.
+
+        The check is conservative: basename, extension and regex exception
+        patterns can match at any depth, fullpath ones are compared one
+        path component at a time against dirname.
+
+        :param dirname: directory path, relative to the patterns root and
+            using '/' as separator.
+        """
+        dir_parts = [p for p in dirname.split('/') if p]
+        for pat in self._exceptions:
+            if Globster.identify(pat) != "fullpath" or pat.startswith('RE:'):
+                return True
+            pat_parts = [p for p in pat.split('/') if p and p != '.']
+            if len(pat_parts) <= len(dir_parts):
+                if '**' not in pat_parts:
+                    continue
+            for dir_part, pat_part in zip(dir_parts, pat_parts):
+                if pat_part.startswith('**'):
+                    return True
+                if not fnmatch.fnmatchcase(dir_part, pat_part):
+                    break
+            else:
+                return True
+        return False
+
 class _OrderedGlobster(Globster):
     """A Globster that keeps pattern order."""
 
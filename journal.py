@@ -0,0 +1,176 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from typing import Any, Dict, Iterator, Optional
+import json
+import os
+import threading
+import time
+
+from Snapshot import (DirSnapshotType, IndexedDataType, json_to_snapshot,
+                      snapshot_to_json, sort_snapshot)
+
+
+class ChangeJournal(object):
+    """
+    Append only log of the changes made to a snapshot.
+
+    Each line of the journal file is a json record with a sequence
+    number `seq' and a timestamp `time'. Change records have op "set" or
+    "remove", the `index' changed ('files', 'subdirs' or 'root'), the
+    entry `path' and its `before' and `after' data (None when missing).
+    Checkpoint records, op "checkpoint", name a full snapshot file,
+    stored next to the journal, from which later changes are replayed.
+
+    Args:
+        path (str): Path of the journal file, created if missing.
+        fsync (bool): whether to fsync after each record.
+    """
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = os.path.abspath(path)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._seq = 0
+        if os.path.isfile(self.path):
+            for record in self.records():
+                self._seq = record['seq']
+
+    @property
+    def seq(self) -> int:
+        """
+        Sequence number of the last record, 0 if empty.
+        """
+        return self._seq
+
+    def _append(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            self._seq += 1
+            record['seq'] = self._seq
+            record.setdefault('time', time.time())
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        return record
+
+    def record(self, index: str, path: str,
+               before: Optional[IndexedDataType],
+               after: Optional[IndexedDataType]) -> Dict[str, Any]:
+        """
+        Append the change of one entry. after None means removed.
+        """
+        if before == after:
+            return None
+        return self._append({
+            'op': 'remove' if after is None else 'set',
+            'index': index, 'path': path,
+            'before': before, 'after': after,
+        })
+
+    def record_diff(self, old_snapshot: DirSnapshotType,
+                    new_snapshot: DirSnapshotType) -> int:
+        """
+        Append the changes turning old_snapshot into new_snapshot.
+
+        Returns:
+            the number of records appended.
+        """
+        count = 0
+        for index in ('root', 'subdirs', 'files'):
+            old = old_snapshot.get(index, {})
+            new = new_snapshot.get(index, {})
+            for path in old.keys() | new.keys():
+                if self.record(index, path, old.get(path), new.get(path)):
+                    count += 1
+        return count
+
+    def checkpoint(self, snapshot: DirSnapshotType) -> Dict[str, Any]:
+        """
+        Store snapshot as a full checkpoint and append a record of it.
+        """
+        with self._lock:
+            name = '{0}.{1}.json'.format(os.path.basename(self.path),
+                                         self._seq + 1)
+        with open(os.path.join(os.path.dirname(self.path), name), 'w') as f:
+            f.write(snapshot_to_json(snapshot))
+        return self._append({'op': 'checkpoint', 'snapshot': name})
+
+    def records(self, since_seq: int = 0) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the records with a sequence number above since_seq.
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record['seq'] > since_seq:
+                    yield record
+
+    def load_checkpoint(self, record: Dict[str, Any]) -> DirSnapshotType:
+        with open(os.path.join(os.path.dirname(self.path),
+                               record['snapshot']), 'r') as f:
+            return json_to_snapshot(f.read())
+
+    def reconstruct(self, seq: int = None,
+                    timestamp: float = None) -> DirSnapshotType:
+        """
+        Return the snapshot as it was at record seq, or at timestamp,
+        by default after the last record.
+
+        Starts from the latest checkpoint before that point and replays
+        the following changes. The snapshot is in canonical order, see
+        sort_snapshot.
+        """
+        checkpoint = None
+        changes = []
+        for record in self.records():
+            if ((seq is not None and record['seq'] > seq) or
+                    (timestamp is not None and record['time'] > timestamp)):
+                break
+            if record['op'] == 'checkpoint':
+                checkpoint = record
+                changes = []
+            else:
+                changes.append(record)
+        if checkpoint is None:
+            snapshot = {'root': {}, 'subdirs': {}, 'files': {}}
+        else:
+            snapshot = self.load_checkpoint(checkpoint)
+        return sort_snapshot(replay(snapshot, changes))
+
+
+def replay(snapshot: DirSnapshotType, records) -> DirSnapshotType:
+    """
+    Apply journal change records to snapshot, in place, and return it.
+    """
+    for record in records:
+        if record['op'] == 'checkpoint':
+            continue
+        index = snapshot.setdefault(record['index'], {})
+        if record['op'] == 'remove':
+            index.pop(record['path'], None)
+        else:
+            index[record['path']] = dict(record['after'])
+    return snapshot
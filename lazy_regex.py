@@ -27,6 +27,9 @@ be used by existing Python modules that create regexs.
 from __future__ import absolute_import
 
 import re
+import threading
+import time
+import weakref
 
 class InvalidPattern(Exception):
     pass
@@ -45,6 +48,7 @@ class LazyRegex(object):
     # We use slots to keep the overhead low. But we need a slot entry for
     # all of the attributes we will copy
     __slots__ = ['_real_regex', '_regex_args', '_regex_kwargs',
+                 '__weakref__',
                 ] + _regex_attributes_to_copy
 
     def __init__(self, args=(), kwargs={}):
@@ -56,13 +60,26 @@ class LazyRegex(object):
         self._real_regex = None
         self._regex_args = args
         self._regex_kwargs = kwargs
+        _pending.add(self)
 
     def _compile_and_collapse(self):
         """Actually compile the requested regex"""
-        self._real_regex = self._real_re_compile(*self._regex_args,
-                                                 **self._regex_kwargs)
+        start = time.perf_counter()
+        real_regex = self._real_re_compile(*self._regex_args,
+                                           **self._regex_kwargs)
+        _record_compile(self._pattern(), time.perf_counter() - start)
         for attr in self._regex_attributes_to_copy:
-            setattr(self, attr, getattr(self._real_regex, attr))
+            setattr(self, attr, getattr(real_regex, attr))
+        # Set last: other threads only skip compilation once every
+        # collapsed attribute is in place.
+        self._real_regex = real_regex
+        _pending.discard(self)
+
+    def _pattern(self):
+        """The pattern, passed positionally or as the pattern keyword"""
+        if self._regex_args:
+            return self._regex_args[0]
+        return self._regex_kwargs.get('pattern')
 
     def _real_re_compile(self, *args, **kwargs):
         """Thunk over to the original re.compile"""
@@ -85,6 +102,7 @@ class LazyRegex(object):
         self._real_regex = None
         setattr(self, "_regex_args", dict["args"])
         setattr(self, "_regex_kwargs", dict["kwargs"])
+        _pending.add(self)
 
     def __getattr__(self, attr):
         """Return a member from the proxied regex object.
@@ -106,6 +124,112 @@ def lazy_compile(*args, **kwargs):
     return LazyRegex(args, kwargs)
 
 
+class CompileStats(object):
+    """Compile count and timings collected for a single pattern."""
+
+    __slots__ = ['pattern', 'count', 'total_time', 'max_time']
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __repr__(self):
+        return '%s(%r, count=%d, total_time=%.6f)' % (
+            self.__class__.__name__, self.pattern, self.count,
+            self.total_time)
+
+
+# LazyRegex proxies which have not been compiled yet, see warmup().
+_pending = weakref.WeakSet()
+# pattern -> CompileStats, filled by _record_compile()
+_compile_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record_compile(pattern, elapsed):
+    """Account one compilation of `pattern' which took `elapsed' seconds."""
+    with _stats_lock:
+        stats = _compile_stats.get(pattern)
+        if stats is None:
+            stats = _compile_stats[pattern] = CompileStats(pattern)
+        stats.count += 1
+        stats.total_time += elapsed
+        if elapsed > stats.max_time:
+            stats.max_time = elapsed
+
+
+def get_compile_stats():
+    """Return a snapshot of the compile statistics.
+
+    :return: a dict mapping each compiled pattern to a dict with the
+        `count', `total_time' and `max_time' (in seconds) of its compilations.
+    """
+    with _stats_lock:
+        return dict((pattern, {'count': s.count,
+                               'total_time': s.total_time,
+                               'max_time': s.max_time})
+                    for pattern, s in _compile_stats.items())
+
+
+def compile_stats_summary():
+    """Return the totals of the compile statistics.
+
+    :return: a dict with the number of distinct `patterns', the total
+        `count' of compilations, their `total_time' and the number of
+        proxies still `pending' compilation.
+    """
+    with _stats_lock:
+        count = sum(s.count for s in _compile_stats.values())
+        total_time = sum(s.total_time for s in _compile_stats.values())
+        patterns = len(_compile_stats)
+    return {'patterns': patterns, 'count': count, 'total_time': total_time,
+            'pending': pending_count()}
+
+
+def reset_compile_stats():
+    """Forget all the compile statistics recorded so far."""
+    with _stats_lock:
+        _compile_stats.clear()
+
+
+def pending_count():
+    """Return the number of LazyRegex proxies not compiled yet."""
+    return len(_pending)
+
+
+def warmup(background=True):
+    """Compile all the LazyRegex proxies which are still pending.
+
+    Meant to be called during startup so that the compile cost is not paid
+    on the first match. Invalid patterns are skipped here, they will raise
+    InvalidPattern as usual when they are first used.
+
+    :param background: if True the compilation happens in a daemon thread
+        which is returned and can be joined, otherwise it happens before
+        returning.
+    :return: the started threading.Thread or None if not in background.
+    """
+    if not background:
+        _warmup()
+        return None
+    thread = threading.Thread(target=_warmup, name='lazy_regex-warmup')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _warmup():
+    for proxy in list(_pending):
+        if proxy._real_regex is not None:
+            continue
+        try:
+            proxy._compile_and_collapse()
+        except InvalidPattern:
+            _pending.discard(proxy)
+
+
 def install_lazy_compile():
     """Make lazy_compile the default compile mode for regex compilation.
 
@@ -0,0 +1,189 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from typing import List, Set, Tuple
+import logging
+import os
+import shutil
+import tempfile
+
+from Snapshot import DirSnapshotType, compare_entry
+
+log = logging.getLogger("objectstore")
+
+# linux/fs.h FICLONE, clone the whole content of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str) -> None:
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+_LINKERS = {
+    "hardlink": os.link,
+    "reflink": _reflink,
+    "copy": shutil.copyfile,
+}
+
+
+def link_file(src: str, dst: str, modes: Tuple[str, ...]) -> str:
+    """
+    Create dst with the content of src trying each of modes in order.
+
+    dst is written to a temporary name first and renamed in place, so it
+    is never seen half written.
+
+    Returns:
+        the mode that succeeded.
+    """
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(dst))
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        for mode in modes:
+            try:
+                _LINKERS[mode](src, tmp)
+            except (OSError, ImportError) as exc:
+                log.debug("{0} {1} -> {2} failed: {3}".format(
+                    mode, src, dst, exc))
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                continue
+            os.replace(tmp, dst)
+            return mode
+        raise OSError("Could not link {0} to {1} with {2}".format(
+            src, dst, modes))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ObjectStore(object):
+    """
+    Content addressed store of the files of snapshots.
+
+    Objects are keyed by the value of one file indexer, the xxhash by
+    default, and stored as objects/<2 first chars>/<rest>. Files with the
+    same content, in any snapshot or root, are stored once.
+
+    Hardlinked objects share the inode with the linked files: an in place
+    write to one silently changes the object stored under its old digest,
+    and every checkout of it. "hardlink" is therefore only used when
+    passed in modes explicitly, for files known never to be written to.
+
+    Args:
+        root (str): Path of the store directory, created if missing.
+        key (str): name of the file indexer used as object key.
+        modes (tuple): ways to populate the store and checkouts, tried
+            in order among "reflink", "hardlink" and "copy". Reflink,
+            else copy by default.
+    """
+
+    def __init__(self, root: str, key: str = "xxhash",
+                 modes: Tuple[str, ...] = ("reflink", "copy")):
+        self.root = os.path.abspath(root)
+        self.key = key
+        self.modes = tuple(modes)
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+
+    def object_path(self, digest: str) -> str:
+        """
+        Return the path of the object with the given digest.
+        """
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def has(self, digest: str) -> bool:
+        return os.path.isfile(self.object_path(digest))
+
+    def add_file(self, path: str, digest: str) -> bool:
+        """
+        Store the file at path under digest, if not already stored.
+
+        Returns:
+            True if a new object was stored.
+        """
+        obj = self.object_path(digest)
+        if os.path.isfile(obj):
+            return False
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        link_file(path, obj, self.modes)
+        return True
+
+    def add_snapshot(self, snapshot: DirSnapshotType,
+                     root_path: str = None) -> int:
+        """
+        Store the files of a snapshot missing from the store.
+
+        Args:
+            root_path (str): directory the snapshot paths are relative to,
+                the snapshot root by default.
+
+        Returns:
+            the number of new objects stored.
+        """
+        root_path = root_path or next(iter(snapshot['root']))
+        added = 0
+        for f, data in snapshot['files'].items():
+            digest = data.get(self.key)
+            if digest is None:
+                log.debug("{0} has no {1}, not stored".format(f, self.key))
+                continue
+            if self.add_file(os.path.join(root_path, f), digest):
+                added += 1
+        return added
+
+    def missing(self, snapshot: DirSnapshotType) -> Set[str]:
+        """
+        Return the digests of the snapshot files not in the store.
+        """
+        return set(data[self.key] for data in snapshot['files'].values()
+                   if self.key in data and not self.has(data[self.key]))
+
+    def checkout(self, snapshot: DirSnapshotType, target_dir: str,
+                 current: DirSnapshotType = None) -> List[str]:
+        """
+        Materialize the files of a snapshot in target_dir from the store.
+
+        Args:
+            current (dict): snapshot of target_dir as it is now, if given
+                the files it reports as not modified are left untouched.
+
+        Returns:
+            the relative paths of the files written.
+        """
+        for d in snapshot['subdirs']:
+            os.makedirs(os.path.join(target_dir, d), exist_ok=True)
+        written = []
+        for f, data in snapshot['files'].items():
+            if (current is not None and f in current['files']
+                    and compare_entry(data, current['files'][f],
+                                      self.key) == 0):
+                continue
+            digest = data.get(self.key)
+            if digest is None or not self.has(digest):
+                raise KeyError("Object for {0} is not in the store: "
+                               "{1}".format(f, digest))
+            target = os.path.join(target_dir, f)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            link_file(self.object_path(digest), target, self.modes)
+            written.append(f)
+        return written
@@ -0,0 +1,499 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from typing import Dict, List, Optional, Tuple, Union
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+from Snapshot import (Dir, DirSnapshotType, FileIndexers, IndexerType,
+                      compute_file, compute_subdir, set_read_hook,
+                      sort_snapshot)
+from progress import ProgressTracker
+
+log = logging.getLogger("pipeline")
+
+# sorts after every file in the queue, see PipelinedSnapshot._hash
+_STOP = float('inf')
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket refilled at rate tokens per second, up to
+    burst tokens.
+
+    acquire() waits until the bucket is not empty and then takes the
+    tokens asked, going into debt when more than available: a big
+    request goes through at once and delays the following ones.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """
+        Take amount tokens, waiting as needed.
+
+        Returns:
+            the seconds waited.
+        """
+        waited = 0.0
+        while 1:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens
+                                   + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens > 0:
+                    self._tokens -= amount
+                    return waited
+                delay = -self._tokens / self.rate + 0.001
+            time.sleep(delay)
+            waited += delay
+
+
+class IOBudget(object):
+    """
+    Bytes per second and read operations per second limits shared by
+    all the indexing threads, each unlimited when None.
+    """
+
+    def __init__(self, bytes_per_second: float = None, iops: float = None):
+        self.bytes = (TokenBucket(bytes_per_second)
+                      if bytes_per_second else None)
+        self.ops = TokenBucket(iops) if iops else None
+
+    def consume(self, nbytes: int, ops: int = 1) -> None:
+        if self.ops is not None:
+            self.ops.acquire(ops)
+        if self.bytes is not None:
+            self.bytes.acquire(nbytes)
+
+
+class AIMDLimiter(object):
+    """
+    Concurrency limit tuned by additive increase, multiplicative decrease.
+
+    Workers hold a slot, see acquire and release, while indexing a file
+    and report the size and duration of each block read with sample().
+    Every window seconds the mean block latency is compared to the best
+    seen: while it stays within tolerance the device is not saturated
+    and the limit grows by one, when it rises above, or above
+    latency_target if set, the limit is multiplied by decrease. The limit
+    settles where more concurrency stops paying off: low on spinning
+    disks, up to max_limit on NVMe.
+    """
+
+    def __init__(self, min_limit: int = 1, max_limit: int = 16,
+                 window: float = 1.0, tolerance: float = 0.5,
+                 decrease: float = 0.7, latency_target: float = None):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = self.min_limit
+        self.window = window
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.best_latency: Optional[float] = None
+        self.history: List[Tuple[float, int, float, float]] = []
+        self._active = 0
+        self._cond = threading.Condition()
+        self._window_start = time.monotonic()
+        self._bytes = 0
+        self._ops = 0
+        self._busy = 0.0
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def sample(self, nbytes: int, latency: float) -> None:
+        """
+        Account a block of nbytes read in latency seconds.
+        """
+        with self._cond:
+            self._bytes += nbytes
+            self._ops += 1
+            self._busy += latency
+            now = time.monotonic()
+            if now - self._window_start >= self.window:
+                self._adjust(now)
+
+    def _adjust(self, now: float) -> None:
+        elapsed = now - self._window_start
+        latency = self._busy / self._ops
+        throughput = self._bytes / elapsed
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if ((self.latency_target and latency > self.latency_target)
+                or latency > self.best_latency * (1 + self.tolerance)):
+            limit = max(self.min_limit, int(self.limit * self.decrease))
+        else:
+            limit = min(self.max_limit, self.limit + 1)
+        self.history.append((now, self.limit, throughput, latency))
+        log.debug("limit {0} -> {1}, {2:.1f} MB/s, {3:.6f}s/block".format(
+            self.limit, limit, throughput / 1e6, latency))
+        if limit > self.limit:
+            self._cond.notify(limit - self.limit)
+        self.limit = limit
+        self._window_start = now
+        self._bytes = 0
+        self._ops = 0
+        self._busy = 0.0
+
+
+def device_is_rotational(st_dev: int) -> Optional[bool]:
+    """
+    Return whether st_dev is a spinning disk, from the sysfs rotational
+    flag of its block device or of the disk of its partition. None when
+    unknown, eg. not on Linux or for network and virtual file systems.
+    """
+    if not hasattr(os, 'major'):
+        return None
+    path = "/sys/dev/block/{0}:{1}".format(os.major(st_dev),
+                                           os.minor(st_dev))
+    for queue_dir in (os.path.join(path, 'queue'),
+                      os.path.join(path, '..', 'queue')):
+        try:
+            with open(os.path.join(queue_dir, 'rotational'), 'r') as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+
+class _Device(object):
+    """
+    Queue, worker threads and limiter of the files of one st_dev.
+    """
+
+    def __init__(self, st_dev: int, workers: int, queue_size: int,
+                 adaptive: bool):
+        self.st_dev = st_dev
+        self.workers = workers
+        self.queue = queue.PriorityQueue(maxsize=max(1, queue_size))
+        self.limiter = AIMDLimiter(1, workers) if adaptive else None
+        self.threads: List[threading.Thread] = []
+
+
+class PipelinedSnapshot(object):
+    """
+    Snapshot of a directory where walking and hashing overlap.
+
+    A walker thread walks the directory, stats each file and queues it
+    as soon as it is found, while worker threads index the queued files.
+    The walked totals are reported to the progress tracker, if any, as
+    they grow. Workers take the largest queued file first, so that big
+    files do not end up hashed alone at the end of the run.
+
+    Files are queued by device (st_dev), each device has its own workers
+    and the devices are indexed in parallel: by default `workers' for
+    SSDs and unknown devices and `hdd_workers' for spinning disks, see
+    device_is_rotational, or the count given in device_workers.
+
+    Reads can be limited to an IOBudget of bytes and blocks per second,
+    shared by all devices, and the number of workers of each device
+    indexing at once tuned by an AIMDLimiter, both applied to the blocks
+    read by FileIndexers.read_blocks.
+
+    The result is the same as snapshot_dir with the same arguments.
+
+    Args:
+        target_dir (str): Path of the target directory.
+        excludes (list): gitignore like patterns to exclude.
+        file_indexers (list): name / function tuples applied to files.
+        dir_indexers (list): name / function tuples applied to subdirs.
+        track_links (bool): index hardlinked inodes once, see
+            snapshot_dir.
+        workers (int): number of indexing threads per device, the
+            maximum concurrency when adaptive.
+        queue_size (int): maximum number of walked files waiting to be
+            indexed on a device, the walker blocks when reached.
+        progress (ProgressTracker): optional progress tracker.
+        bytes_per_second (float): read bandwidth budget, None for none.
+        iops (float): blocks read per second budget, None for none.
+        adaptive (bool): tune the concurrency of each device with an
+            AIMDLimiter, starting from one worker.
+        hdd_workers (int): number of indexing threads of spinning disks.
+        device_workers (dict): number of indexing threads by st_dev, or
+            by the path of a file or directory on the device.
+        walk_workers (int): number of threads listing directories, see
+            Dir.walk_parallel.
+        ignore_files (list): names of per directory ignore files, eg.
+            ['.gitignore', '.exclude'], see Dir.
+    """
+
+    def __init__(self, target_dir: str,
+                 excludes: List[str] = ['.git/', '.hg/', '.svn/'],
+                 file_indexers: List[IndexerType] = [FileIndexers.XXHASH64()],
+                 dir_indexers: List[IndexerType] = [],
+                 track_links: bool = False,
+                 workers: int = 4,
+                 queue_size: int = 65536,
+                 progress: ProgressTracker = None,
+                 bytes_per_second: float = None,
+                 iops: float = None,
+                 adaptive: bool = False,
+                 hdd_workers: int = 1,
+                 device_workers: Dict[Union[int, str], int] = None,
+                 walk_workers: int = 1,
+                 ignore_files: List[str] = None):
+        self.dir = Dir(target_dir, excludes=excludes,
+                       ignore_files=ignore_files)
+        self.file_indexers = dict(file_indexers)
+        self.dir_indexers = dict(dir_indexers)
+        self.track_links = track_links
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.budget = (IOBudget(bytes_per_second, iops)
+                       if bytes_per_second or iops else None)
+        self.walk_workers = walk_workers
+        self.adaptive = adaptive
+        self.queue_size = queue_size
+        self.hdd_workers = max(1, hdd_workers)
+        self.device_workers: Dict[int, int] = {}
+        for device, count in (device_workers or {}).items():
+            if isinstance(device, str):
+                device = os.stat(device).st_dev
+            self.device_workers[device] = max(1, count)
+        self.devices: Dict[int, _Device] = {}
+        self._root_dev = os.stat(self.dir.path).st_dev
+        # limiter of each worker
+        self._local = threading.local()
+        self._seq = itertools.count()
+        self._files: List[str] = []
+        self._subdirs: List[str] = []
+        self._sizes: Dict[str, int] = {}
+        # relative path of the first link / other links of an inode
+        self._inodes: Dict[str, List[str]] = {}
+        self._results: Dict[str, dict] = {}
+        self._errors: List[BaseException] = []
+        self._abort = threading.Event()
+
+    def _put(self, device: _Device, item: Tuple) -> None:
+        while not self._abort.is_set():
+            try:
+                device.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def workers_for(self, st_dev: int) -> int:
+        """
+        Return the number of indexing threads of the device st_dev.
+        """
+        if st_dev in self.device_workers:
+            return self.device_workers[st_dev]
+        if device_is_rotational(st_dev):
+            return self.hdd_workers
+        return self.workers
+
+    def _device(self, st_dev: int) -> _Device:
+        """
+        Return the device st_dev, starting its workers on first use.
+        """
+        device = self.devices.get(st_dev)
+        if device is None:
+            device = _Device(st_dev, self.workers_for(st_dev),
+                             self.queue_size, self.adaptive)
+            log.debug("device {0}: {1} workers".format(st_dev,
+                                                        device.workers))
+            for i in range(device.workers):
+                thread = threading.Thread(
+                    target=self._hash, args=(device,), daemon=True,
+                    name="snapshot-hasher-{0}-{1}".format(st_dev, i))
+                device.threads.append(thread)
+                thread.start()
+            self.devices[st_dev] = device
+        return device
+
+    def _walk(self) -> None:
+        try:
+            if self.walk_workers > 1:
+                walk = self.dir.walk_parallel(self.walk_workers)
+            else:
+                walk = self.dir.walk()
+            for root, dirs, files in walk:
+                for d in dirs:
+                    self._subdirs.append(self.dir.relpath(
+                        os.path.join(root, d)))
+                for f in files:
+                    if self._abort.is_set():
+                        return
+                    self._add_file(self.dir.relpath(os.path.join(root, f)))
+        except BaseException as exc:
+            self._errors.append(exc)
+            self._abort.set()
+        finally:
+            for device in self.devices.values():
+                for _ in range(device.workers):
+                    self._put(device, (_STOP, next(self._seq), None))
+
+    def _add_file(self, f: str) -> None:
+        try:
+            st = os.lstat(self.dir.abspath(f))
+        except OSError as exc:
+            if self.progress is not None:
+                self.progress.error(f, "stat", exc)
+            st = None
+        size = 0 if st is None else st.st_size
+        self._files.append(f)
+        self._sizes[f] = size
+        if self.progress is not None:
+            self.progress.walked(f, size)
+        if self.track_links and st is not None and st.st_nlink > 1:
+            inode = "{0}:{1}".format(st.st_dev, st.st_ino)
+            if inode in self._inodes:
+                self._inodes[inode].append(f)
+                return
+            self._inodes[inode] = [f]
+        device = self._device(self._root_dev if st is None else st.st_dev)
+        self._put(device, (-size, next(self._seq), f))
+
+    def _on_read(self, nbytes: int, seconds: float) -> None:
+        """
+        Read hook of the workers, called after each block read with the
+        time the read alone took, so that the limiter follows the device
+        latency and not the hashing.
+        """
+        limiter = self._local.limiter
+        if limiter is not None:
+            limiter.sample(nbytes, seconds)
+        if self.budget is not None:
+            self.budget.consume(nbytes)
+
+    def _index(self, f: str) -> None:
+        limiter = self._local.limiter
+        if limiter is None:
+            self._results[f] = compute_file(
+                self.dir, f, self.file_indexers, self.progress)
+            return
+        limiter.acquire()
+        try:
+            self._results[f] = compute_file(
+                self.dir, f, self.file_indexers, self.progress)
+        finally:
+            limiter.release()
+
+    def _hash(self, device: _Device) -> None:
+        self._local.limiter = device.limiter
+        if self.budget is not None or device.limiter is not None:
+            set_read_hook(self._on_read)
+        try:
+            while not self._abort.is_set():
+                try:
+                    priority, _, f = device.queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if priority == _STOP:
+                    return
+                self._index(f)
+                if self.progress is not None:
+                    self.progress.indexed(f, self._sizes[f])
+        except BaseException as exc:
+            self._errors.append(exc)
+            self._abort.set()
+        finally:
+            set_read_hook(None)
+
+    def run(self) -> DirSnapshotType:
+        """
+        Walk and index the directory.
+
+        Returns:
+            the snapshot dict.
+        """
+        walker = threading.Thread(target=self._walk, name="snapshot-walker",
+                                  daemon=True)
+        walker.start()
+        try:
+            walker.join()
+            # the walker started the workers of every device it met
+            for device in self.devices.values():
+                for thread in device.threads:
+                    thread.join()
+        except BaseException:
+            self._abort.set()
+            raise
+        if self._errors:
+            raise self._errors[0]
+
+        state = {}
+        state['root'] = {self.dir.path: compute_subdir(
+            self.dir, ".", self.dir_indexers, self.progress)}
+        state['subdirs'] = dict(
+            (d, compute_subdir(self.dir, d, self.dir_indexers, self.progress))
+            for d in self._subdirs)
+        for paths in self._inodes.values():
+            for f in paths[1:]:
+                self._results[f] = dict(self._results[paths[0]])
+                if self.progress is not None:
+                    self.progress.indexed(f, self._sizes[f])
+        state['files'] = dict((f, self._results[f]) for f in self._files)
+        if self.track_links:
+            state['links'] = dict((inode, {'paths': paths})
+                                  for inode, paths in self._inodes.items()
+                                  if len(paths) > 1)
+        if self.progress is not None:
+            self.progress.done()
+        return sort_snapshot(state)
+
+
+def snapshot_dir_pipelined(target_dir: str,
+                           excludes: List[str] = ['.git/', '.hg/', '.svn/'],
+                           file_indexers: List[IndexerType] =
+                           [FileIndexers.XXHASH64()],
+                           dir_indexers: List[IndexerType] = [],
+                           track_links: bool = False,
+                           workers: int = 4,
+                           progress: ProgressTracker = None,
+                           bytes_per_second: float = None,
+                           iops: float = None,
+                           adaptive: bool = False,
+                           hdd_workers: int = 1,
+                           device_workers: Dict[Union[int, str], int] = None,
+                           walk_workers: int = 1,
+                           ignore_files: List[str] = None
+                           ) -> DirSnapshotType:
+    """
+    snapshot_dir walking and hashing in parallel, see PipelinedSnapshot.
+    """
+    return PipelinedSnapshot(target_dir, excludes, file_indexers,
+                             dir_indexers, track_links, workers,
+                             progress=progress,
+                             bytes_per_second=bytes_per_second, iops=iops,
+                             adaptive=adaptive, hdd_workers=hdd_workers,
+                             device_workers=device_workers,
+                             walk_workers=walk_workers,
+                             ignore_files=ignore_files).run()
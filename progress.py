@@ -0,0 +1,253 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from collections import deque
+from typing import Callable, List, NamedTuple, Optional
+import json
+import logging
+import sys
+import threading
+import time
+
+log = logging.getLogger("progress")
+
+
+class SnapshotError(NamedTuple):
+    """
+    An entry that could not be stat'ed or indexed.
+
+    operation is "stat" or the name of the failing indexer.
+    """
+    path: str
+    operation: str
+    error: str
+    message: str
+
+
+class ProgressEvent(NamedTuple):
+    """
+    State of a snapshot when the event was emitted.
+
+    kind is "walk" (pre-walk progress), "file" (indexing progress),
+    "error" (error is set) or "done". rate is the bytes indexed per
+    second over the last seconds, eta the estimated seconds left, None
+    while unknown.
+    """
+    kind: str
+    elapsed: float
+    files_walked: int
+    bytes_walked: int
+    files_indexed: int
+    bytes_indexed: int
+    rate: float
+    eta: Optional[float]
+    path: str = None
+    error: SnapshotError = None
+
+
+SinkType = Callable[[ProgressEvent], None]
+
+
+class ProgressTracker(object):
+    """
+    Counts the progress of a snapshot and sends ProgressEvent to sinks.
+
+    snapshot_dir first walks the files, reporting each with walked(),
+    which sets the totals the ETA is computed from, then reports each
+    indexed file with indexed(). Errors are collected in `errors' and
+    emitted immediately, other events at most every interval seconds.
+
+    Args:
+        sinks (list): callables receiving each ProgressEvent.
+        interval (float): minimum seconds between two progress events.
+        rate_window (float): seconds of history the rate is computed on.
+    """
+
+    def __init__(self, sinks: List[SinkType] = None, interval: float = 0.5,
+                 rate_window: float = 10.0):
+        self.sinks = list(sinks or [])
+        self.interval = interval
+        self.rate_window = rate_window
+        self.errors: List[SnapshotError] = []
+        self.files_walked = 0
+        self.bytes_walked = 0
+        self.files_indexed = 0
+        self.bytes_indexed = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_emit = 0.0
+        # (time, bytes_indexed) samples of the rate window
+        self._samples = deque([(self._start, 0)])
+
+    def rate(self, now: float = None) -> float:
+        """
+        Return the bytes indexed per second over the rate window.
+        """
+        now = time.monotonic() if now is None else now
+        first_time, first_bytes = self._samples[0]
+        if now <= first_time:
+            return 0.0
+        return (self.bytes_indexed - first_bytes) / (now - first_time)
+
+    def eta(self, now: float = None) -> Optional[float]:
+        """
+        Return the estimated seconds left, from the walked totals and the
+        current rate, None if unknown.
+        """
+        rate = self.rate(now)
+        if self.bytes_walked and rate > 0:
+            return max(0.0, (self.bytes_walked - self.bytes_indexed) / rate)
+        if self.files_walked and self.files_indexed:
+            now = time.monotonic() if now is None else now
+            per_file = (now - self._start) / self.files_indexed
+            return max(0.0, (self.files_walked - self.files_indexed)
+                       * per_file)
+        return None
+
+    def _event(self, kind: str, now: float, path: str = None,
+               error: SnapshotError = None) -> ProgressEvent:
+        return ProgressEvent(kind, now - self._start, self.files_walked,
+                             self.bytes_walked, self.files_indexed,
+                             self.bytes_indexed, self.rate(now),
+                             self.eta(now), path, error)
+
+    def _emit(self, event: ProgressEvent) -> None:
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception as exc:
+                log.warning("Progress sink {0} failed: {1}".format(sink, exc))
+
+    def _maybe_emit(self, kind: str, path: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_emit < self.interval:
+                return
+            self._last_emit = now
+            self._samples.append((now, self.bytes_indexed))
+            while (len(self._samples) > 2
+                   and now - self._samples[0][0] > self.rate_window):
+                self._samples.popleft()
+            event = self._event(kind, now, path)
+        self._emit(event)
+
+    def walked(self, path: str, nbytes: int) -> None:
+        """
+        Count a file found by the walk, of nbytes bytes.
+        """
+        with self._lock:
+            self.files_walked += 1
+            self.bytes_walked += nbytes
+        self._maybe_emit("walk", path)
+
+    def indexed(self, path: str, nbytes: int) -> None:
+        """
+        Count a file done indexing, of nbytes bytes.
+        """
+        with self._lock:
+            self.files_indexed += 1
+            self.bytes_indexed += nbytes
+        self._maybe_emit("file", path)
+
+    def error(self, path: str, operation: str, exc: Exception) -> None:
+        """
+        Collect the error of operation on path and emit it.
+        """
+        error = SnapshotError(path, operation, type(exc).__name__, str(exc))
+        with self._lock:
+            self.errors.append(error)
+            event = self._event("error", time.monotonic(), path, error)
+        self._emit(event)
+
+    def done(self) -> None:
+        """
+        Emit the final totals.
+        """
+        with self._lock:
+            event = self._event("done", time.monotonic())
+        self._emit(event)
+
+
+def format_event(event: ProgressEvent) -> str:
+    """
+    Return a one line human readable status of event.
+    """
+    if event.kind == "error":
+        return "error {0}: {1} {2}: {3}".format(
+            event.error.operation, event.path, event.error.error,
+            event.error.message)
+    if event.kind == "walk":
+        return "walked {0} files, {1:.1f} MB".format(
+            event.files_walked, event.bytes_walked / 1e6)
+    eta = ("--" if event.eta is None
+           else time.strftime("%H:%M:%S", time.gmtime(event.eta)))
+    return "{0} {1}/{2} files, {3:.1f}/{4:.1f} MB, {5:.1f} MB/s, ETA {6}".format(
+        "done" if event.kind == "done" else "indexed",
+        event.files_indexed, event.files_walked, event.bytes_indexed / 1e6,
+        event.bytes_walked / 1e6, event.rate / 1e6, eta)
+
+
+class LogSink(object):
+    """
+    Sink logging the events, errors as warnings.
+    """
+
+    def __init__(self, logger: logging.Logger = log,
+                 level: int = logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, event: ProgressEvent) -> None:
+        level = logging.WARNING if event.kind == "error" else self.level
+        self.logger.log(level, format_event(event))
+
+
+class StreamSink(object):
+    """
+    Sink writing a status line to a terminal stream, rewritten in place.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def __call__(self, event: ProgressEvent) -> None:
+        if event.kind == "error":
+            self.stream.write("\r\033[K" + format_event(event) + "\n")
+        else:
+            end = "\n" if event.kind == "done" else ""
+            self.stream.write("\r\033[K" + format_event(event) + end)
+        self.stream.flush()
+
+
+class JsonLinesSink(object):
+    """
+    Sink appending the events as json lines to a file, for monitoring.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event: ProgressEvent) -> None:
+        record = event._asdict()
+        if event.error is not None:
+            record['error'] = event.error._asdict()
+        with self._lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
@@ -18,8 +18,181 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import hashlib
+import os
+import re
+import shutil
 import subprocess
-from typing import List
+import tarfile
+import tempfile
+import zipfile
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# `7z l -slt` prints one "Key = Value" line per property
+reSltProperty = re.compile(r'^(\w[\w ]*?) = (.*)$')
+
+
+class ArchiveEntry(NamedTuple):
+    """
+    Structured archive member, as listed by SevenZip.list_archive_entries.
+
+    Paths always use '/' as separator, crc is None when the format does
+    not store it (tar).
+    """
+    path: str
+    size: int
+    crc: Optional[int]
+    attributes: str
+    is_dir: bool
+
+
+def normalize_member(name: str) -> str:
+    """
+    Return an archive member name using '/', without the leading './'
+    nor the trailing '/', as tar -C dir . and Windows zip tools write
+    them. The archive root ('.') gives ''.
+    """
+    name = name.replace('\\', '/')
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.rstrip('/')
+    return '' if name == '.' else name
+
+
+def _zip_attributes(info: zipfile.ZipInfo) -> str:
+    """
+    Return the 7z like attributes string of a zip member.
+    """
+    dos_attr = info.external_attr & 0xFFFF
+    attributes = ''
+    for flag, letter in ((0x10, 'D'), (0x01, 'R'), (0x02, 'H'),
+                         (0x04, 'S'), (0x20, 'A')):
+        if dos_attr & flag or (letter == 'D' and info.is_dir()):
+            attributes += letter
+    return attributes
+
+
+def _zip_entries(archive: zipfile.ZipFile) -> List[ArchiveEntry]:
+    return [ArchiveEntry(normalize_member(info.filename),
+                         info.file_size, info.CRC, _zip_attributes(info),
+                         info.is_dir())
+            for info in archive.infolist()]
+
+
+def _tar_entries(archive: tarfile.TarFile) -> List[ArchiveEntry]:
+    entries = []
+    for info in archive.getmembers():
+        if not (info.isfile() or info.isdir()):
+            continue
+        entries.append(ArchiveEntry(normalize_member(info.name), info.size,
+                                    None, 'D' if info.isdir() else '',
+                                    info.isdir()))
+    return entries
+
+
+def _slt_entry(properties: Dict[str, str]) -> ArchiveEntry:
+    """
+    Return the ArchiveEntry of a `7z l -slt` property block.
+    """
+    attributes = properties.get('Attributes', '')
+    is_dir = properties.get('Folder') == '+' or attributes.startswith('D')
+    crc = properties.get('CRC')
+    return ArchiveEntry(normalize_member(properties['Path']),
+                        int(properties.get('Size') or 0),
+                        int(crc, 16) if crc else None,
+                        attributes, is_dir)
+
+
+def _parse_slt(output: str) -> Dict[str, List[ArchiveEntry]]:
+    """
+    Parse the output of `7z l -slt` run on one or more archives.
+
+    Returns:
+        dict of archive path / list of entries, in archive order.
+    """
+    listing = {}
+    archive = None
+    in_entries = False
+    properties = {}
+    for line in output.splitlines() + ['']:
+        if line.startswith('Listing archive: '):
+            archive = line[len('Listing archive: '):].strip()
+            listing[archive] = []
+            in_entries = False
+        elif line.startswith('----------'):
+            in_entries = True
+            properties = {}
+        elif not line.strip():
+            if in_entries and archive is not None and 'Path' in properties:
+                listing[archive].append(_slt_entry(properties))
+            properties = {}
+        else:
+            match = reSltProperty.match(line)
+            if match:
+                properties[match.group(1)] = match.group(2)
+    return listing
+
+
+def is_safe_member(member_path: str) -> bool:
+    """
+    Return whether an archive member path stays inside the folder it is
+    extracted to: it is relative, without drive and '..' components.
+    """
+    if not member_path or member_path.startswith(('/', '\\')):
+        return False
+    if re.match(r'^[A-Za-z]:', member_path):
+        return False
+    return '..' not in re.split(r'[\\/]', member_path)
+
+
+def _extraction_target(output_folder: str, relpath: str) -> str:
+    """
+    Return the path relpath is written to in output_folder.
+
+    Raises ValueError if it is unsafe or would resolve outside of
+    output_folder, eg. through a symlink.
+    """
+    if not is_safe_member(relpath):
+        raise ValueError("Unsafe archive member path: {}".format(relpath))
+    target = os.path.join(output_folder, relpath)
+    folder = os.path.realpath(output_folder)
+    if os.path.commonpath([folder, os.path.realpath(target)]) != folder:
+        raise ValueError("Archive member path outside of {}: {}".format(
+            output_folder, relpath))
+    return target
+
+
+class _BoundedReader(object):
+    """
+    Read only the first `size' bytes of a shared stream.
+
+    If the stream ends before, the exception returned by truncated() is
+    raised.
+    """
+
+    def __init__(self, stream, size: int,
+                 truncated: Callable[[], Exception] = None):
+        self._stream = stream
+        self._remaining = size
+        self._truncated = truncated or (lambda: EOFError(
+            "Stream ended {} bytes early".format(self._remaining)))
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size) if size else b''
+        if size and not data:
+            raise self._truncated()
+        self._remaining -= len(data)
+        return data
+
+    def drain(self) -> None:
+        """
+        Skip what the consumer did not read, to reach the next member.
+        """
+        while self._remaining and self.read(1048576):
+            pass
+
 
 class SevenZip(object):
      
@@ -45,11 +218,135 @@ class SevenZip(object):
                         file_list:List[str]=[]) -> None:
         """
         Extracts files from the specified archivied to the folder indicated.
+
+        If file_list is not empty only those archive members are extracted,
+        in a single 7z invocation reading them from a list file.
         """
         # option 'x' extract files with paths, -o{dir_path} specify output folder
-        cmd = [cls.exe_path, 'x', archive_path, '-o{}'.format(output_folder)]
-        # TODO: extract only files from a list. see include (-i{})
-        subprocess.call(cmd)
+        cmd = [cls.exe_path, 'x', archive_path, '-o{}'.format(output_folder),
+               '-y']
+        if not file_list:
+            subprocess.call(cmd)
+            return
+        fd, list_file = tempfile.mkstemp(suffix='.txt', text=True)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(file_list))
+            # -spd: member names are plain paths, not wildcards
+            subprocess.call(cmd + ['-spd', '-scsUTF-8',
+                                   '-i@{}'.format(list_file)])
+        finally:
+            os.remove(list_file)
+
+    @classmethod
+    def extract_members(cls, archive_path: str, output_folder: str,
+                        members: List[str], root: str = "") -> List[str]:
+        """
+        Extract only the listed members, with their paths relative to root.
+
+        Zip and tar members are streamed in process straight to their
+        destination, other formats are extracted by one 7z invocation.
+        Archives are untrusted: members that would be written outside of
+        output_folder raise ValueError, before anything is extracted.
+
+        Args:
+            members (list): archive member paths, using '/' as separator.
+            root (str): path inside the archive stripped from the
+                destination paths, it must prefix all members.
+
+        Returns:
+            list of the written paths, relative to output_folder.
+        """
+        root = root.strip('/')
+        prefix = root + '/' if root else ''
+        wanted = set(members)
+
+        def destination(member_path):
+            return member_path[len(prefix):].replace('/', os.sep)
+
+        for member_path in members:
+            _extraction_target(output_folder, destination(member_path))
+
+        written = []
+        fmt = cls.native_format(archive_path)
+        if fmt == 'zip':
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    name = normalize_member(info.filename)
+                    if name in wanted and not info.is_dir():
+                        with archive.open(info) as src:
+                            cls._write_member(src, output_folder,
+                                              destination(name))
+                        written.append(destination(name))
+        elif fmt == 'tar':
+            with tarfile.open(archive_path, 'r|*') as archive:
+                for info in archive:
+                    name = normalize_member(info.name)
+                    if name in wanted and info.isfile():
+                        cls._write_member(archive.extractfile(info),
+                                          output_folder, destination(name))
+                        written.append(destination(name))
+        elif members:
+            os.makedirs(output_folder, exist_ok=True)
+            # 7z can't strip root: extract next to the destination and
+            # move the files in place, renames on the same volume are cheap
+            staging = tempfile.mkdtemp(prefix='.extract-', dir=output_folder)
+            try:
+                cls.extract_archive(archive_path, staging, members)
+                for member_path in members:
+                    staged = os.path.join(staging,
+                                          member_path.replace('/', os.sep))
+                    if not os.path.isfile(staged):
+                        continue
+                    target = _extraction_target(output_folder,
+                                                destination(member_path))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(staged, target)
+                    written.append(destination(member_path))
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+        return written
+
+    @staticmethod
+    def _write_member(src, output_folder: str, relpath: str) -> None:
+        target = _extraction_target(output_folder, relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1048576)
+
+    @classmethod
+    def extract_diff(cls, archive_path: str, output_folder: str,
+                     diff: Dict[str, List[str]], root: str = "",
+                     remove_deleted=False) -> List[str]:
+        """
+        Bring output_folder up to date with an archive writing only the
+        files that changed.
+
+        Args:
+            diff (dict): result of compare_dir_snapshot(archive_snapshot,
+                folder_snapshot), its `created' and `modified' files are
+                extracted.
+            root (str): path inside the archive matching output_folder,
+                the same used for the archive snapshot.
+            remove_deleted (bool): whether to also remove the `deleted'
+                files, those missing from the archive, from output_folder.
+
+        Returns:
+            list of the written paths, relative to output_folder.
+        """
+        root = root.replace('\\', '/').strip('/')
+        prefix = root + '/' if root else ''
+        members = [prefix + relpath.replace(os.sep, '/')
+                   for relpath in diff.get('created', []) +
+                   diff.get('modified', [])]
+        written = cls.extract_members(archive_path, output_folder,
+                                      members, root)
+        if remove_deleted:
+            for relpath in diff.get('deleted', []):
+                target = _extraction_target(output_folder, relpath)
+                if os.path.isfile(target):
+                    os.remove(target)
+        return written
 
     @classmethod
     def list_archive_contents(cls, archive_path:str, recurse=True) -> List[str]:
@@ -74,4 +371,187 @@ class SevenZip(object):
         """
         cmd = [cls.exe_path, 'h', "-scrc{}".format(method), file_path]
         calculated_hash = subprocess.check_output(cmd).decode('utf-8').splitlines()
-        return calculated_hash
\ No newline at end of file
+        return calculated_hash
+
+    @classmethod
+    def calculate_hashes(cls, file_paths: List[str],
+                         method="CRC32") -> Dict[str, str]:
+        """
+        Calculate the hash of several files with a single 7z invocation.
+
+        Returns:
+            dict of file path (as printed by 7z) / hash.
+        """
+        if not file_paths:
+            return {}
+        cmd = [cls.exe_path, 'h', "-scrc{}".format(method), '--'] + file_paths
+        output = subprocess.check_output(cmd).decode('utf-8').splitlines()
+        hashes = {}
+        separators = 0
+        for line in output:
+            if line.startswith('-----'):
+                separators += 1
+            elif separators == 1 and line.strip():
+                fields = line.split(None, 2)
+                if len(fields) == 3:
+                    hashes[fields[2]] = fields[0]
+        return hashes
+
+    @staticmethod
+    def native_format(archive_path: str) -> Optional[str]:
+        """
+        Return 'zip' or 'tar' if the archive can be read in process
+        without 7z, None otherwise.
+        """
+        if zipfile.is_zipfile(archive_path):
+            return 'zip'
+        if tarfile.is_tarfile(archive_path):
+            return 'tar'
+        return None
+
+    @classmethod
+    def list_archive_entries(cls, archive_path: str) -> List[ArchiveEntry]:
+        """
+        List archive contents as structured entries.
+
+        Zip and tar archives are read in process, other formats are
+        listed by 7z.
+        """
+        return cls.list_archives_entries([archive_path])[archive_path]
+
+    @classmethod
+    def list_archives_entries(cls, archive_paths: List[str]
+                              ) -> Dict[str, List[ArchiveEntry]]:
+        """
+        List the contents of several archives.
+
+        Zip and tar archives are read in process, all the others are
+        listed by one batched 7z invocation.
+
+        Returns:
+            dict of archive path / list of entries, in archive order.
+        """
+        listing = {}
+        others = []
+        for archive_path in archive_paths:
+            fmt = cls.native_format(archive_path)
+            if fmt == 'zip':
+                with zipfile.ZipFile(archive_path) as archive:
+                    listing[archive_path] = _zip_entries(archive)
+            elif fmt == 'tar':
+                with tarfile.open(archive_path) as archive:
+                    listing[archive_path] = _tar_entries(archive)
+            else:
+                others.append(archive_path)
+        if others:
+            listed = cls._list_with_7z(others)
+            for archive_path in others:
+                listing[archive_path] = listed.get(
+                    os.path.abspath(archive_path),
+                    listed.get(archive_path, []))
+        return listing
+
+    @classmethod
+    def _list_with_7z(cls, archive_paths: List[str]
+                      ) -> Dict[str, List[ArchiveEntry]]:
+        """
+        Run `7z l -slt` once over all archive_paths, passed in a list file.
+        """
+        fd, list_file = tempfile.mkstemp(suffix='.txt', text=True)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(os.path.abspath(p) for p in archive_paths))
+            cmd = [cls.exe_path, 'l', '-slt', '-sccUTF-8', '-an',
+                   '-ai@{}'.format(list_file)]
+            output = subprocess.check_output(cmd).decode('utf-8')
+        finally:
+            os.remove(list_file)
+        listing = _parse_slt(output)
+        return dict((os.path.abspath(k), v) for k, v in listing.items())
+
+    @classmethod
+    def iter_entry_hashes(cls, archive_path: str,
+                          hash_factory: Callable = hashlib.sha256,
+                          blocksize: int = 1048576
+                          ) -> Iterator[Tuple[ArchiveEntry, str]]:
+        """
+        Yield (entry, hexdigest) for each file in the archive, hashing
+        the member streams without extracting them to disk.
+
+        Zip and tar members are read in process, other formats are
+        streamed by a single `7z x -so` and split on the listed sizes.
+
+        Args:
+            hash_factory (callable): returns a new hashlib like object,
+                eg. hashlib.sha256 or xxhash.xxh64.
+        """
+        for entry, stream in cls.iter_entry_streams(archive_path):
+            hasher = hash_factory()
+            while True:
+                data = stream.read(blocksize)
+                if not data:
+                    break
+                hasher.update(data)
+            yield entry, hasher.hexdigest()
+
+    @classmethod
+    def iter_entry_streams(cls, archive_path: str):
+        """
+        Yield (entry, readable stream) for each file in the archive,
+        in archive order. Each stream is only valid until the next one
+        is yielded.
+
+        With 7z, reading a member cut short, eg. by a corrupt, encrypted
+        or truncated archive, and a failed 7z run raise OSError.
+        """
+        fmt = cls.native_format(archive_path)
+        if fmt == 'zip':
+            with zipfile.ZipFile(archive_path) as archive:
+                for info, entry in zip(archive.infolist(),
+                                       _zip_entries(archive)):
+                    if entry.is_dir:
+                        continue
+                    with archive.open(info) as stream:
+                        yield entry, stream
+        elif fmt == 'tar':
+            # stream mode: members are read in order, no seeking back
+            with tarfile.open(archive_path, 'r|*') as archive:
+                for info in archive:
+                    if not info.isfile():
+                        continue
+                    entry = ArchiveEntry(normalize_member(info.name),
+                                         info.size, None, '', False)
+                    yield entry, archive.extractfile(info)
+        else:
+            entries = [e for e in cls.list_archive_entries(archive_path)
+                       if not e.is_dir]
+            cmd = [cls.exe_path, 'x', '-so', '-y', archive_path]
+            # a file, not a pipe: 7z can't block on it while stdout is read
+            errors = tempfile.TemporaryFile()
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=errors)
+
+            def failure(reason):
+                proc.stdout.close()
+                returncode = proc.wait()
+                errors.seek(0)
+                return OSError("{0}: {1}\n7z return value: {2}\n{3}".format(
+                    archive_path, reason, returncode,
+                    errors.read().decode('utf-8', 'replace').strip()))
+
+            try:
+                for entry in entries:
+                    stream = _BoundedReader(
+                        proc.stdout, entry.size,
+                        lambda path=entry.path: failure(
+                            "Extraction of {0} cut short".format(path)))
+                    yield entry, stream
+                    stream.drain()
+                while proc.stdout.read(1048576):
+                    pass
+                if proc.wait():
+                    raise failure("Extraction failed")
+            finally:
+                proc.stdout.close()
+                proc.wait()
+                errors.close()
@@ -0,0 +1,322 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from typing import Any, Dict, List, Tuple
+import datetime
+import json
+import sqlite3
+import time
+
+import Snapshot
+from Snapshot import DirSnapshotType
+
+# entries.kind values
+FILE = 0
+SUBDIR = 1
+_KINDS = (('files', FILE), ('subdirs', SUBDIR))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    root TEXT NOT NULL,
+    root_data TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entries (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots(id) ON DELETE CASCADE,
+    kind INTEGER NOT NULL,
+    path_id INTEGER NOT NULL REFERENCES paths(id),
+    PRIMARY KEY (snapshot_id, kind, path_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entry_values (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots(id) ON DELETE CASCADE,
+    path_id INTEGER NOT NULL REFERENCES paths(id),
+    indexer TEXT NOT NULL,
+    value,
+    PRIMARY KEY (snapshot_id, path_id, indexer)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path_id, snapshot_id);
+CREATE INDEX IF NOT EXISTS entry_values_path
+    ON entry_values (path_id, indexer, snapshot_id);
+CREATE INDEX IF NOT EXISTS snapshots_created ON snapshots (created);
+"""
+
+# Common files of two snapshots which are modified or whose state is
+# unknown, following compare_entry: no shared indexer means unknown.
+_CHANGED_FILES = """
+WITH cmp AS (
+    SELECT ov.path_id, COUNT(*) AS shared,
+           SUM(ov.value IS NOT nv.value) AS changed
+    FROM entry_values ov
+    JOIN entry_values nv ON nv.snapshot_id = :new
+        AND nv.path_id = ov.path_id AND nv.indexer = ov.indexer
+    WHERE ov.snapshot_id = :old AND (:key IS NULL OR ov.indexer = :key)
+    GROUP BY ov.path_id
+)
+SELECT p.path, COALESCE(cmp.shared, 0), COALESCE(cmp.changed, 0)
+FROM entries o
+JOIN entries n ON n.snapshot_id = :new AND n.kind = o.kind
+    AND n.path_id = o.path_id
+JOIN paths p ON p.id = o.path_id
+LEFT JOIN cmp ON cmp.path_id = o.path_id
+WHERE o.snapshot_id = :old AND o.kind = 0
+    AND (COALESCE(cmp.shared, 0) = 0 OR cmp.changed > 0)
+"""
+
+# Entries of kind in snapshot :a missing from snapshot :b
+_MISSING_ENTRIES = """
+SELECT p.path FROM entries a
+JOIN paths p ON p.id = a.path_id
+WHERE a.snapshot_id = :a AND a.kind = :kind AND NOT EXISTS (
+    SELECT 1 FROM entries b WHERE b.snapshot_id = :b AND b.kind = :kind
+        AND b.path_id = a.path_id)
+"""
+
+
+class SnapshotDB(object):
+    """
+    SQLite store of many snapshots, answering queries across them with
+    indexes instead of loading each json snapshot.
+
+    Paths are stored once and shared by all the snapshots, each entry
+    value is a row keyed by snapshot id, path and indexer name. Values
+    are stored as given, so indexers should return str, int or float.
+
+    Args:
+        db_path (str): Path of the database file, ':memory:' for a
+            temporary one.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def add_snapshot(self, snapshot: DirSnapshotType, name: str = None,
+                     created: float = None) -> int:
+        """
+        Insert a snapshot in a single transaction.
+
+        Returns:
+            the id of the new snapshot.
+        """
+        root, root_data = next(iter(snapshot['root'].items()))
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO snapshots (name, root, root_data, created) "
+                "VALUES (?, ?, ?, ?)",
+                (name, root, json.dumps(root_data),
+                 time.time() if created is None else created))
+            snapshot_id = cur.lastrowid
+            path_ids = self._intern_paths(
+                [p for key, _ in _KINDS for p in snapshot[key]])
+            for key, kind in _KINDS:
+                index = snapshot[key]
+                self.conn.executemany(
+                    "INSERT INTO entries (snapshot_id, kind, path_id) "
+                    "VALUES (?, ?, ?)",
+                    ((snapshot_id, kind, path_ids[p]) for p in index))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO entry_values "
+                    "(snapshot_id, path_id, indexer, value) "
+                    "VALUES (?, ?, ?, ?)",
+                    ((snapshot_id, path_ids[p], indexer, value)
+                     for p, data in index.items()
+                     for indexer, value in data.items()))
+        return snapshot_id
+
+    def _intern_paths(self, paths: List[str]) -> Dict[str, int]:
+        """
+        Return path / id of paths, inserting the new ones.
+        """
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS new_paths "
+                          "(path TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM new_paths")
+        self.conn.executemany("INSERT OR IGNORE INTO new_paths VALUES (?)",
+                              ((p,) for p in paths))
+        self.conn.execute("INSERT OR IGNORE INTO paths (path) "
+                          "SELECT path FROM new_paths")
+        path_ids = dict((path, path_id) for path_id, path in
+                        self.conn.execute("SELECT p.id, p.path FROM paths p "
+                                          "JOIN new_paths n USING (path)"))
+        self.conn.execute("DELETE FROM new_paths")
+        return path_ids
+
+    def snapshot_dir(self, targetDir: str, name: str = None,
+                     **kwargs) -> int:
+        """
+        Take a snapshot_dir of targetDir, extra arguments, eg.
+        ignore_files, are passed on, and insert it.
+
+        Returns:
+            the id of the new snapshot.
+        """
+        return self.add_snapshot(Snapshot.snapshot_dir(targetDir, **kwargs),
+                                 name)
+
+    def snapshots(self) -> List[Tuple[int, str, str, float]]:
+        """
+        Return (id, name, root, created) of all snapshots, oldest first.
+        """
+        return self.conn.execute(
+            "SELECT id, name, root, created FROM snapshots "
+            "ORDER BY created, id").fetchall()
+
+    def load_snapshot(self, snapshot_id: int) -> DirSnapshotType:
+        """
+        Return a stored snapshot in the snapshot_dir format.
+        """
+        row = self.conn.execute(
+            "SELECT root, root_data FROM snapshots WHERE id = ?",
+            (snapshot_id,)).fetchone()
+        if row is None:
+            raise KeyError("No snapshot with id {0}".format(snapshot_id))
+        state = {'root': {row[0]: json.loads(row[1])}}
+        for key, kind in _KINDS:
+            index = {}
+            for path, indexer, value in self.conn.execute(
+                    "SELECT p.path, v.indexer, v.value FROM entries e "
+                    "JOIN paths p ON p.id = e.path_id "
+                    "LEFT JOIN entry_values v ON v.snapshot_id = "
+                    "e.snapshot_id AND v.path_id = e.path_id "
+                    "WHERE e.snapshot_id = ? AND e.kind = ? "
+                    "ORDER BY p.path",
+                    (snapshot_id, kind)):
+                data = index.setdefault(path, {})
+                if indexer is not None:
+                    data[indexer] = value
+            state[key] = index
+        return state
+
+    def file_history(self, path: str,
+                     kind: int = FILE) -> List[Tuple[int, float,
+                                                     Dict[str, Any]]]:
+        """
+        Return (snapshot id, created, data) of each snapshot holding path,
+        oldest first.
+        """
+        history = []
+        rows = self.conn.execute(
+            "SELECT s.id, s.created, v.indexer, v.value FROM paths p "
+            "JOIN entries e ON e.path_id = p.id AND e.kind = ? "
+            "JOIN snapshots s ON s.id = e.snapshot_id "
+            "LEFT JOIN entry_values v ON v.snapshot_id = e.snapshot_id "
+            "AND v.path_id = e.path_id "
+            "WHERE p.path = ? ORDER BY s.created, s.id", (kind, path))
+        for snapshot_id, created, indexer, value in rows:
+            if not history or history[-1][0] != snapshot_id:
+                history.append((snapshot_id, created, {}))
+            if indexer is not None:
+                history[-1][2][indexer] = value
+        return history
+
+    def last_changed(self, path: str, cmp_key: str = None) -> int:
+        """
+        Return the id of the latest snapshot in which path was created or
+        modified, compared with the snapshot before it. None if unknown.
+        """
+        ids = [row[0] for row in self.snapshots()]
+        history = dict((snapshot_id, data) for snapshot_id, _, data
+                       in self.file_history(path))
+        changed = None
+        previous = None
+        for snapshot_id in ids:
+            data = history.get(snapshot_id)
+            if data is not None and (previous is None or
+                                     Snapshot.compare_entry(
+                                         data, previous, cmp_key) == 1):
+                changed = snapshot_id
+            previous = data
+        return changed
+
+    def diff(self, new_id: int, old_id: int, cmp_key: str = None) -> dict:
+        """
+        Return compare_dir_snapshot of two stored snapshots, computed in SQL.
+        """
+        def missing(a, b, kind):
+            return [row[0] for row in self.conn.execute(
+                _MISSING_ENTRIES, {'a': a, 'b': b, 'kind': kind})]
+
+        data = {}
+        data['deleted'] = missing(old_id, new_id, FILE)
+        data['created'] = missing(new_id, old_id, FILE)
+        data['modified'] = []
+        data['modified_unknown'] = []
+        data['deleted_dirs'] = missing(old_id, new_id, SUBDIR)
+        for path, shared, changed in self.conn.execute(
+                _CHANGED_FILES, {'new': new_id, 'old': old_id,
+                                 'key': cmp_key}):
+            if shared == 0:
+                data['modified_unknown'].append(path)
+            else:
+                data['modified'].append(path)
+        for paths in data.values():
+            paths.sort()
+        return data
+
+    def delete_snapshot(self, snapshot_id: int) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM snapshots WHERE id = ?",
+                              (snapshot_id,))
+
+    def apply_retention(self, keep_last: int = 7,
+                        keep_daily: int = 30) -> List[int]:
+        """
+        Delete old snapshots: the keep_last most recent are kept, then
+        the latest of each day for the keep_daily days before them.
+
+        Returns:
+            the ids of the deleted snapshots.
+        """
+        rows = list(reversed(self.snapshots()))
+        kept_days = set()
+        deleted = []
+        for position, (snapshot_id, _, _, created) in enumerate(rows):
+            if position < keep_last:
+                continue
+            day = datetime.date.fromtimestamp(created)
+            if day not in kept_days and len(kept_days) < keep_daily:
+                kept_days.add(day)
+                continue
+            deleted.append(snapshot_id)
+        with self.conn:
+            self.conn.executemany("DELETE FROM snapshots WHERE id = ?",
+                                  ((i,) for i in deleted))
+        return deleted
+
+    def compact(self) -> None:
+        """
+        Drop the paths no snapshot uses anymore and reclaim the space.
+        """
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM paths WHERE NOT EXISTS "
+                "(SELECT 1 FROM entries e WHERE e.path_id = paths.id)")
+        self.conn.execute("VACUUM")
@@ -0,0 +1,229 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from typing import Dict, List, Optional, Tuple
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from Snapshot import (DirSnapshotType, IndexType, compare_dir_snapshot,
+                      compare_links)
+from compactsnapshot import CompactIndex
+
+log = logging.getLogger("vectordiff")
+
+# numpy dtypes of the compactsnapshot column kinds
+_DTYPES = {
+    'hex64': 'uint64',
+    'float': 'float64',
+    'int': 'int64',
+}
+
+
+class ColumnIndex(object):
+    """
+    Snapshot index held as numpy arrays, for vectorized diffs.
+
+    Rows are those of the CompactIndex of the index: sorted by directory
+    then name. Each indexer with hex digest, float or int values is an
+    array of its values and a bool array of the rows having one, shared
+    with the CompactIndex buffers. Indexers with other values can not be
+    vectorized and are listed in `unsupported'.
+
+    Args:
+        index (dict or CompactIndex): the files index of a snapshot,
+            kept as `index'.
+    """
+
+    def __init__(self, index: IndexType):
+        if np is None:
+            raise ImportError("numpy is required for ColumnIndex")
+        if not isinstance(index, CompactIndex):
+            index = CompactIndex(index)
+        self.index = index
+        self.columns: Dict[str, Tuple[str, 'np.ndarray', 'np.ndarray']] = {}
+        self.unsupported: List[str] = []
+        for name in index.column_names():
+            column = index.column(name)
+            if column.kind not in _DTYPES:
+                self.unsupported.append(name)
+                continue
+            values = np.frombuffer(column.values, dtype=_DTYPES[column.kind])
+            present = np.frombuffer(column.present, dtype=np.uint8) != 0
+            self.columns[name] = (column.kind, values, present)
+        self._paths: Optional[List[str]] = None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def paths(self) -> List[str]:
+        """
+        Paths of the rows, built on first use.
+        """
+        if self._paths is None:
+            self._paths = list(self.index)
+        return self._paths
+
+    def path(self, row: int) -> str:
+        return self.index.path(row)
+
+    def align(self, other: 'ColumnIndex') -> 'np.ndarray':
+        """
+        Return for each row of self the row of the same path in other,
+        -1 when other has no such path.
+
+        Both indexes are sorted by directory then name: the rows of a
+        directory are aligned at once when its names are unchanged, which
+        compares interned strings, else searched with np.searchsorted.
+        """
+        rows = np.full(len(self), -1, dtype=np.int64)
+        other_ranges = dict((prefix, (start, end)) for prefix, start, end
+                            in other.index.prefix_ranges())
+        for prefix, start, end in self.index.prefix_ranges():
+            other_start, other_end = other_ranges.get(prefix, (0, 0))
+            if other_start == other_end:
+                continue
+            names = self.index.names(start, end)
+            other_names = other.index.names(other_start, other_end)
+            if names == other_names:
+                rows[start:end] = np.arange(other_start, other_end)
+                continue
+            names = np.array(names)
+            other_names = np.array(other_names)
+            found = np.searchsorted(other_names, names)
+            hit = found < len(other_names)
+            hit[hit] = other_names[found[hit]] == names[hit]
+            rows[start:end][hit] = other_start + found[hit]
+        return rows
+
+
+def _vectorizable(new: ColumnIndex, old: ColumnIndex,
+                  cmp_key: str = None) -> bool:
+    if cmp_key:
+        names = {cmp_key}
+    else:
+        names = ((new.columns.keys() | set(new.unsupported))
+                 & (old.columns.keys() | set(old.unsupported)))
+    for name in names:
+        if name in new.unsupported or name in old.unsupported:
+            return False
+        if (name in new.columns and name in old.columns
+                and new.columns[name][0] != old.columns[name][0]):
+            # eg. int sizes against float sizes
+            return False
+    return True
+
+
+def _with_index(dir_snapshot: DirSnapshotType) -> DirSnapshotType:
+    """
+    Return dir_snapshot with its files as a mapping, if a ColumnIndex.
+    """
+    files = dir_snapshot['files']
+    if isinstance(files, ColumnIndex):
+        return dict(dir_snapshot, files=files.index)
+    return dir_snapshot
+
+
+def compare_columns(new: ColumnIndex, old: ColumnIndex,
+                    cmp_key: str = None) -> Dict[str, List[str]]:
+    """
+    Vectorized diff of two files indexes, with the semantics of
+    compare_entry: with cmp_key only that indexer is compared, else all
+    the indexers both entries have.
+
+    Returns:
+        dict with the `deleted', `created', `modified' and
+        `modified_unknown' paths.
+    """
+    old_rows = new.align(old)
+    matched = old_rows >= 0
+    new_common = np.flatnonzero(matched)
+    old_common = old_rows[matched]
+    old_seen = np.zeros(len(old), dtype=bool)
+    old_seen[old_common] = True
+
+    known = np.zeros(len(new_common), dtype=bool)
+    modified = np.zeros(len(new_common), dtype=bool)
+    names = [cmp_key] if cmp_key else new.columns.keys() & old.columns.keys()
+    for name in names:
+        if name not in new.columns or name not in old.columns:
+            continue
+        _, new_values, new_present = new.columns[name]
+        _, old_values, old_present = old.columns[name]
+        both = new_present[new_common] & old_present[old_common]
+        known |= both
+        modified |= both & (new_values[new_common] != old_values[old_common])
+
+    # rows are by directory then name, not in plain path order
+    return {
+        'deleted': sorted(old.path(i) for i in np.flatnonzero(~old_seen)),
+        'created': sorted(new.path(i) for i in np.flatnonzero(~matched)),
+        'modified': sorted(new.path(i) for i in new_common[modified]),
+        'modified_unknown': sorted(new.path(i)
+                                   for i in new_common[~known]),
+    }
+
+
+def vector_compare_dir_snapshot(dir_snapshot_new: DirSnapshotType,
+                                dir_snapshot_old: DirSnapshotType,
+                                cmp_key: str = None) -> dict:
+    """
+    compare_dir_snapshot computing the files diff with numpy.
+
+    The files indexes of the snapshots must be CompactIndex (see
+    compactsnapshot) or ColumnIndex, which saves the conversion when
+    diffing a snapshot several times. Falls back to compare_dir_snapshot
+    for plain dict indexes, which it diffs faster than they can be
+    converted, when numpy is missing or when the compared indexers have
+    values that can not be vectorized.
+
+    Returns:
+        the same dict as compare_dir_snapshot.
+    """
+    if np is None:
+        log.debug("numpy not available, using compare_dir_snapshot")
+        return compare_dir_snapshot(dir_snapshot_new, dir_snapshot_old,
+                                    cmp_key)
+    new = dir_snapshot_new['files']
+    old = dir_snapshot_old['files']
+    if not all(isinstance(files, (ColumnIndex, CompactIndex))
+               for files in (new, old)):
+        log.debug("plain dict indexes, using compare_dir_snapshot")
+        return compare_dir_snapshot(_with_index(dir_snapshot_new),
+                                    _with_index(dir_snapshot_old), cmp_key)
+    new = new if isinstance(new, ColumnIndex) else ColumnIndex(new)
+    old = old if isinstance(old, ColumnIndex) else ColumnIndex(old)
+    if not _vectorizable(new, old, cmp_key):
+        log.debug("indexer values can not be vectorized, "
+                  "using compare_dir_snapshot")
+        return compare_dir_snapshot(_with_index(dir_snapshot_new),
+                                    _with_index(dir_snapshot_old), cmp_key)
+
+    data = compare_columns(new, old, cmp_key)
+    data['deleted_dirs'] = sorted(dir_snapshot_old['subdirs'].keys()
+                                  - dir_snapshot_new['subdirs'].keys())
+    if 'links' in dir_snapshot_new and 'links' in dir_snapshot_old:
+        data['links_changed'] = compare_links(_with_index(dir_snapshot_new),
+                                              _with_index(dir_snapshot_old))
+    return data
@@ -0,0 +1,476 @@
+"""Copyright (c) 2020 AL, hjk
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from typing import Dict, List, Set, Tuple
+import bisect
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+from Snapshot import (Dir, DirSnapshotType, FileIndexers, IndexerType,
+                      compare_dir_snapshot, compute_file, compute_subdir,
+                      index_files, index_subdirs, sort_snapshot)
+
+log = logging.getLogger("watcher")
+
+# linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of the Linux inotify API.
+
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not supported")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float) -> List[Tuple[int, int, int, str]]:
+        """
+        Return the pending (wd, mask, cookie, name) events, waiting up to
+        timeout seconds for the first one.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(
+                    buf, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class SnapshotWatcher(object):
+    """
+    Keep an in-memory snapshot of a directory up to date.
+
+    Uses inotify where available, otherwise polls the tree every
+    poll_interval seconds comparing size and mtime. Only the files touched
+    are computed again with compute_file, moves within the tree keep
+    their data without rehashing.
+
+    Args:
+        target_dir (str): Path of the directory to watch.
+        excludes (list): List of gitignore like patters to exclude.
+        file_indexers (list): name / function Tuples, as for snapshot_dir.
+        dir_indexers (list): name / function Tuples, as for snapshot_dir.
+        poll_interval (float): seconds between polls, also the longest
+            wait for stop() to take effect.
+        use_inotify (bool): False forces the polling fallback.
+        journal (ChangeJournal): optional journal recording every change
+            applied to the snapshot.
+        ignore_files (list): names of per directory ignore files, eg.
+            ['.gitignore', '.exclude'], see Dir. A change to one of them
+            triggers a rescan.
+    """
+
+    def __init__(self, target_dir: str,
+                 excludes: List[str] = ['.git/', '.hg/', '.svn/'],
+                 file_indexers: List[IndexerType] = [FileIndexers.XXHASH64()],
+                 dir_indexers: List[IndexerType] = [],
+                 poll_interval: float = 1.0,
+                 use_inotify: bool = True,
+                 journal=None,
+                 ignore_files: List[str] = None):
+        self.dir = Dir(target_dir, excludes=excludes,
+                       ignore_files=ignore_files)
+        self.file_indexers = dict(file_indexers)
+        self.dir_indexers = dict(dir_indexers)
+        self.poll_interval = poll_interval
+        self.journal = journal
+        self._state: DirSnapshotType = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._watches: Dict[int, str] = {}
+        self._stats: Dict[str, Tuple[int, int]] = {}
+        # sorted paths of 'files' and 'subdirs', to find a subtree by bisect
+        self._sorted: Dict[str, List[str]] = {}
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+            except OSError as exc:
+                log.info("inotify unavailable, polling: {0}".format(exc))
+
+    @property
+    def polling(self) -> bool:
+        return self._inotify is None
+
+    def start(self) -> None:
+        """
+        Take the initial snapshot and start watching in a daemon thread.
+        """
+        self.rescan()
+        self._thread = threading.Thread(target=self._run,
+                                        name='SnapshotWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def snapshot(self) -> DirSnapshotType:
+        """
+        Return a copy of the current snapshot.
+        """
+        with self._lock:
+            return sort_snapshot(dict(
+                (key, dict((path, dict(data))
+                           for path, data in index.items()))
+                for key, index in self._state.items()))
+
+    def compare(self, baseline: DirSnapshotType,
+                cmp_key: str = None) -> dict:
+        """
+        Return compare_dir_snapshot(current snapshot, baseline).
+        """
+        with self._lock:
+            return compare_dir_snapshot(self._state, baseline, cmp_key)
+
+    def rescan(self) -> None:
+        """
+        Compute the whole snapshot again, eg. after an event overflow.
+        """
+        dir = self.dir
+        dir.populate(force_refresh=True)
+        state = {}
+        state['root'] = {dir.path: compute_subdir(dir, ".",
+                                                  self.dir_indexers)}
+        state['subdirs'] = index_subdirs(dir, self.dir_indexers)
+        state['files'] = index_files(dir, self.file_indexers)
+        subdirs = list(state['subdirs'])
+        files = list(state['files'])
+        dir.depopulate()
+        with self._lock:
+            if self.journal is not None and self._state is not None:
+                self.journal.record_diff(self._state, state)
+            self._state = state
+            self._sorted = dict((key, sorted(state[key]))
+                                for key in ('files', 'subdirs'))
+            if self.polling:
+                self._stats = dict((f, self._stat(f)) for f in files)
+        if not self.polling:
+            for wd in list(self._watches):
+                self._inotify.rm_watch(wd)
+            self._watches.clear()
+            for d in [''] + subdirs:
+                self._add_watch(d)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.polling:
+                    self._stop.wait(self.poll_interval)
+                    self._poll()
+                else:
+                    events = self._inotify.read_events(self.poll_interval)
+                    if events:
+                        self._apply_events(events)
+            except Exception as exc:
+                log.error("Watcher error, rescanning: {0}".format(exc))
+                self.rescan()
+
+    def _add_watch(self, rel_dir: str) -> None:
+        try:
+            wd = self._inotify.add_watch(self.dir.abspath(rel_dir))
+        except OSError as exc:
+            log.debug("Can't watch {0}: {1}".format(rel_dir, exc))
+            return
+        self._watches[wd] = rel_dir
+
+    def _is_excluded(self, rel_path: str) -> bool:
+        path = self.dir.abspath(rel_path)
+        return self.dir.is_ignored(path) or os.path.islink(path)
+
+    def _apply_events(self, events) -> None:
+        dirty: Set[str] = set()
+        moved_from: Dict[int, Tuple[str, bool]] = {}
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.rescan()
+                return
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None or not name:
+                continue
+            if name in self.dir.ignore_files:
+                # what the walk includes changed
+                self.rescan()
+                return
+            rel_path = rel_dir + '/' + name if rel_dir else name
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (rel_path, is_dir)
+            elif mask & IN_MOVED_TO and cookie in moved_from:
+                old_path, _ = moved_from.pop(cookie)
+                self._move(old_path, rel_path, is_dir)
+                # changes seen before the move are still to be computed
+                old_prefix = old_path + '/'
+                dirty = set(rel_path + p[len(old_path):]
+                            if p == old_path or p.startswith(old_prefix)
+                            else p for p in dirty)
+            elif mask & IN_DELETE:
+                self._remove(rel_path, is_dir)
+                dirty.discard(rel_path)
+            elif is_dir:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(rel_path)
+            else:
+                dirty.add(rel_path)
+        # moved out of the tree
+        for rel_path, is_dir in moved_from.values():
+            if not os.path.lexists(self.dir.abspath(rel_path)):
+                self._remove(rel_path, is_dir)
+                dirty.discard(rel_path)
+        for rel_path in dirty:
+            self._update_file(rel_path)
+
+    def _set(self, key: str, path: str, data: dict) -> None:
+        """
+        Set an entry of the snapshot, holding the lock.
+        """
+        index = self._state[key]
+        if self.journal is not None:
+            self.journal.record(key, path, index.get(path), data)
+        if path not in index:
+            bisect.insort(self._sorted[key], path)
+        index[path] = data
+
+    def _pop(self, key: str, path: str) -> dict:
+        """
+        Remove an entry of the snapshot, holding the lock.
+        """
+        data = self._state[key].pop(path)
+        paths = self._sorted[key]
+        del paths[bisect.bisect_left(paths, path)]
+        if self.journal is not None:
+            self.journal.record(key, path, data, None)
+        return data
+
+    def _update_file(self, rel_path: str) -> None:
+        if (not os.path.isfile(self.dir.abspath(rel_path))
+                or self._is_excluded(rel_path)):
+            return
+        data = compute_file(self.dir, rel_path, self.file_indexers)
+        with self._lock:
+            self._set('files', rel_path, data)
+
+    def _subtree(self, key: str, rel_dir: str) -> List[str]:
+        """
+        Return the paths of the index key at and below rel_dir, holding
+        the lock.
+        """
+        paths = self._sorted[key]
+        # the paths below rel_dir sort between rel_dir + '/' and rel_dir + '0'
+        lo = bisect.bisect_left(paths, rel_dir + '/')
+        hi = bisect.bisect_left(paths, rel_dir + '0', lo)
+        below = paths[lo:hi]
+        if rel_dir in self._state[key]:
+            below.insert(0, rel_dir)
+        return below
+
+    def _remove(self, rel_path: str, is_dir: bool) -> None:
+        with self._lock:
+            if not is_dir:
+                if rel_path in self._state['files']:
+                    self._pop('files', rel_path)
+                self._stats.pop(rel_path, None)
+                return
+            for key in ('files', 'subdirs'):
+                for path in self._subtree(key, rel_path):
+                    self._pop(key, path)
+                    self._stats.pop(path, None)
+        if not self.polling:
+            prefix = rel_path + '/'
+            for wd, rel_dir in list(self._watches.items()):
+                if rel_dir == rel_path or rel_dir.startswith(prefix):
+                    self._inotify.rm_watch(wd)
+                    del self._watches[wd]
+
+    def _move(self, old_path: str, new_path: str, is_dir: bool) -> None:
+        """
+        Move the data of old_path and of everything below it to new_path.
+        """
+        with self._lock:
+            was_known = old_path in self._state[
+                'subdirs' if is_dir else 'files']
+            for key in ('files', 'subdirs'):
+                if is_dir:
+                    paths = self._subtree(key, old_path)
+                elif old_path in self._state[key]:
+                    paths = [old_path]
+                else:
+                    paths = []
+                for path in paths:
+                    data = self._pop(key, path)
+                    moved = new_path + path[len(old_path):]
+                    if not self._is_excluded(moved):
+                        self._set(key, moved, data)
+        if not is_dir:
+            if not was_known:
+                # moved in from an excluded name
+                self._update_file(new_path)
+            return
+        if not self.polling:
+            # watches follow the moved directory, only their paths change
+            old_prefix = old_path + '/'
+            for wd, rel_dir in list(self._watches.items()):
+                if rel_dir == old_path or rel_dir.startswith(old_prefix):
+                    self._watches[wd] = new_path + rel_dir[len(old_path):]
+        if not was_known:
+            # moved in from an excluded directory
+            self._add_tree(new_path)
+
+    def _add_tree(self, rel_dir: str) -> None:
+        """
+        Index a directory that appeared in the tree, with its contents.
+        """
+        if self._is_excluded(rel_dir):
+            return
+        if not self.polling:
+            self._add_watch(rel_dir)
+        subdirs = {rel_dir: compute_subdir(self.dir, rel_dir,
+                                           self.dir_indexers)}
+        files = {}
+        for root, dirs, names in os.walk(self.dir.abspath(rel_dir)):
+            for d in list(dirs):
+                rel = self.dir.relpath(os.path.join(root, d))
+                if self._is_excluded(rel):
+                    dirs.remove(d)
+                    continue
+                if not self.polling:
+                    self._add_watch(rel)
+                subdirs[rel] = compute_subdir(self.dir, rel,
+                                              self.dir_indexers)
+            for name in names:
+                rel = self.dir.relpath(os.path.join(root, name))
+                if not self._is_excluded(rel):
+                    files[rel] = compute_file(self.dir, rel,
+                                              self.file_indexers)
+        with self._lock:
+            for d, data in subdirs.items():
+                self._set('subdirs', d, data)
+            for f, data in files.items():
+                self._set('files', f, data)
+
+    def _stat(self, rel_path: str) -> Tuple[int, int]:
+        try:
+            st = os.stat(self.dir.abspath(rel_path))
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def _poll(self) -> None:
+        """
+        Polling fallback: walk the tree, recompute the files whose size or
+        mtime changed and drop the vanished ones.
+        """
+        dir = self.dir
+        dir.populate(force_refresh=True)
+        files = list(dir.iterfiles())
+        subdirs = set(dir.itersubdirs())
+        dir.depopulate()
+        seen = set(files)
+        changed = [f for f in files if self._stats.get(f) != self._stat(f)]
+        new_data = dict((f, compute_file(dir, f, self.file_indexers))
+                        for f in changed)
+        with self._lock:
+            index = self._state['files']
+            for f in [p for p in index if p not in seen]:
+                self._pop('files', f)
+                self._stats.pop(f, None)
+            for f, data in new_data.items():
+                self._set('files', f, data)
+            for f in changed:
+                self._stats[f] = self._stat(f)
+            old_subdirs = self._state['subdirs']
+            for d in [p for p in old_subdirs if p not in subdirs]:
+                self._pop('subdirs', d)
+            for d in subdirs:
+                if d not in old_subdirs:
+                    self._set('subdirs', d,
+                              compute_subdir(dir, d, self.dir_indexers))